@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Cold-tier storage for old coffee uses.
+#
+# Uses older than the archive horizon are moved out of the hot base into
+# immutable, gzip-compressed JSON-lines segments partitioned by month:
+#
+#   uses/<YYYY-MM>/<created (ms)>.jsonl.gz
+#
+# Segments are stored in a Deta Drive (or a local directory with the same
+# interface) and are never modified, so decoded segments can be cached
+# indefinitely. A month may have several segments if it was archived in steps.
+# Deleting archived uses replaces the segments that hold them with new ones.
+#
+# Other processes change the segments as well, so the listing is cached per
+# archive generation (kept in the meta record and bumped with every change). A
+# listed segment that has gone since is replaced by the current segments of
+# its month.
+#
+
+import gzip
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+SEGMENT_PREFIX = "uses/"
+SEGMENT_SUFFIX = ".jsonl.gz"
+SEGMENT_CACHE_SIZE = 64
+
+
+#### ---- Local drive ---- ####
+
+
+class LocalDriveBody:
+    def __init__(self, data: bytes) -> None:
+        self._data = data
+
+    def read(self) -> bytes:
+        return self._data
+
+    def close(self) -> None:
+        return None
+
+
+class LocalDrive:
+    # A stand-in for Deta Drive backed by a local directory.
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, *name.split("/"))
+
+    def put(self, name: str, data: bytes) -> str:
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        return name
+
+    def get(self, name: str) -> Optional[LocalDriveBody]:
+        try:
+            with open(self._path(name), "rb") as file:
+                return LocalDriveBody(file.read())
+        except FileNotFoundError:
+            return None
+
+    def list(
+        self,
+        limit: int = 1000,
+        prefix: Optional[str] = None,
+        last: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        names: List[str] = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith(".tmp"):
+                    continue
+                path = os.path.relpath(os.path.join(root, file), self.directory)
+                names.append(path.replace(os.sep, "/"))
+        names = sorted(n for n in names if prefix is None or n.startswith(prefix))
+        if last is not None:
+            names = [n for n in names if n > last]
+        paging: Dict[str, Any] = {"size": min(len(names), limit)}
+        if len(names) > limit:
+            paging["last"] = names[limit - 1]
+        return {"names": names[:limit], "paging": paging}
+
+    def delete(self, name: str) -> str:
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+        return name
+
+    def delete_many(self, names: List[str]) -> Dict[str, List[str]]:
+        return {"deleted": [self.delete(name) for name in names]}
+
+
+#### ---- Segments ---- ####
+
+
+def use_month(info: Dict[str, Any]) -> str:
+    # `_seconds` is milliseconds since the epoch of the (naive) use datetime.
+    return datetime.utcfromtimestamp(info["_seconds"] / 1000.0).strftime("%Y-%m")
+
+
+def segment_name(month: str, created: int) -> str:
+    return f"{SEGMENT_PREFIX}{month}/{created}{SEGMENT_SUFFIX}"
+
+
+def segment_month(name: str) -> str:
+    return name[len(SEGMENT_PREFIX) :].split("/")[0]
+
+
+def encode_segment(infos: List[Dict[str, Any]]) -> bytes:
+    lines = "\n".join(json.dumps(info, separators=(",", ":")) for info in infos)
+    return gzip.compress(lines.encode(), compresslevel=9)
+
+
+def decode_segment(data: bytes) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in gzip.decompress(data).splitlines() if line]
+
+
+def _matches(
+    info: Dict[str, Any], since_ms: Optional[float], bag_id: Optional[str]
+) -> bool:
+    if since_ms is not None and info["_seconds"] <= since_ms:
+        return False
+    return bag_id is None or info["bag_id"] == bag_id
+
+
+class SegmentArchive:
+    def __init__(self, drive: Any, cache_size: int = SEGMENT_CACHE_SIZE) -> None:
+        self.drive = drive
+        self.cache_size = cache_size
+        self._names: Optional[List[str]] = None
+        self._names_version: Tuple[Optional[float], int] = (None, 0)
+        self._cache: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = Lock()
+
+    def segment_names(
+        self, horizon: Optional[float] = None, generation: int = 0
+    ) -> List[str]:
+        if self._names is None or (horizon, generation) != self._names_version:
+            names: List[str] = []
+            last: Optional[str] = None
+            while True:
+                res = self.drive.list(prefix=SEGMENT_PREFIX, last=last)
+                names += res["names"]
+                last = res.get("paging", {}).get("last")
+                if last is None:
+                    break
+            self._names = sorted(names)
+            self._names_version = (horizon, generation)
+            with self._lock:
+                # A name that has gone may be taken again by a new segment.
+                for name in set(self._cache).difference(names):
+                    del self._cache[name]
+        return self._names
+
+    def write(self, infos: List[Dict[str, Any]]) -> List[str]:
+        months: Dict[str, List[Dict[str, Any]]] = {}
+        for info in infos:
+            months.setdefault(use_month(info), []).append(info)
+
+        created = int(time.time() * 1000)
+        names: List[str] = []
+        for month, month_infos in sorted(months.items()):
+            month_infos.sort(key=lambda x: x["_seconds"])
+            name = segment_name(month, created)
+            self.drive.put(name, encode_segment(month_infos))
+            names.append(name)
+        self._names = None
+        return names
+
+    def read_segment(self, name: str) -> List[Dict[str, Any]]:
+        infos = self._read_segment(name)
+        return [] if infos is None else infos
+
+    def _read_segment(self, name: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                return self._cache[name]
+
+        body = self.drive.get(name)
+        if body is None:
+            return None
+        infos = decode_segment(body.read())
+        body.close()
+
+        with self._lock:
+            self._cache[name] = infos
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return infos
+
+    def read(
+        self,
+        since_ms: Optional[float] = None,
+        bag_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        horizon: Optional[float] = None,
+        generation: int = 0,
+    ) -> Iterator[Dict[str, Any]]:
+        # Months are read newest first; once `limit` uses have been found, no
+        # older month can hold a more recent one.
+        since_month: Optional[str] = None
+        if since_ms is not None:
+            since_month = use_month({"_seconds": since_ms})
+
+        n = 0
+        previous_month: Optional[str] = None
+        names = self.segment_names(horizon=horizon, generation=generation)
+        for name in reversed(names):
+            month = segment_month(name)
+            if limit is not None and n >= limit and month != previous_month:
+                break
+            if since_month is not None and month < since_month:
+                break
+            previous_month = month
+            for info in self._month_segment(name, names):
+                if _matches(info, since_ms=since_ms, bag_id=bag_id):
+                    n += 1
+                    yield info
+
+    def _month_segment(self, name: str, names: List[str]) -> List[Dict[str, Any]]:
+        infos = self._read_segment(name)
+        if infos is not None:
+            return infos
+        # Replaced by another process before its generation was bumped: the
+        # uses are in the new segments of the month (duplicates are dropped
+        # when merging).
+        self._names = None
+        month = segment_month(name)
+        infos = []
+        for new_name in self.segment_names():
+            if segment_month(new_name) == month and new_name not in names:
+                infos += self.read_segment(new_name)
+        return infos
+
+    def delete(
+        self, keys: List[str], horizon: Optional[float] = None, generation: int = 0
+    ) -> List[str]:
+        # The uses of a month that are kept are written to a new segment before
+        # the old segments are removed, so a failure leaves the uses in place
+        # (duplicates are dropped when merging). Returns the deleted keys.
+        to_delete = set(keys)
+        names = self.segment_names(horizon=horizon, generation=generation)
+        months: Dict[str, List[str]] = {}
+        for name in names:
+            if any(info["key"] in to_delete for info in self.read_segment(name)):
+                months.setdefault(segment_month(name), []).append(name)
+
+        created = int(time.time() * 1000)
+        deleted: Set[str] = set()
+        for month, old_names in sorted(months.items()):
+            kept: List[Dict[str, Any]] = []
+            for name in old_names:
+                for info in self.read_segment(name):
+                    if info["key"] in to_delete:
+                        deleted.add(info["key"])
+                    else:
+                        kept.append(info)
+            if len(kept) > 0:
+                while segment_name(month, created) in names:
+                    created += 1
+                kept.sort(key=lambda x: x["_seconds"])
+                self.drive.put(segment_name(month, created), encode_segment(kept))
+            self.drive.delete_many(old_names)
+            with self._lock:
+                for name in old_names:
+                    self._cache.pop(name, None)
+        if len(months) > 0:
+            self._names = None
+        return sorted(deleted)
+
+    def delete_all(self) -> None:
+        names = self.segment_names()
+        for i in range(0, len(names), 1000):
+            # Deta Drive deletes at most 1000 files per request.
+            self.drive.delete_many(names[i : i + 1000])
+        with self._lock:
+            self._cache.clear()
+        self._names = None
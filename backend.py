@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# A resilient wrapper around a Deta `Base`.
+#
+# Every call runs in a worker thread with a timeout. Idempotent reads (`get`
+# and the `_fetch` pages behind `fetch`) are retried with jittered exponential
+# backoff, and a read that is slower than a percentile of the recent read
+# latencies gets a hedged duplicate; whichever finishes first wins. Writes are
+# not retried because `update` (increments) and `insert` are not idempotent.
+# A circuit breaker fails calls fast while the backend keeps failing; an
+# `insert` of a key that exists is an answer, not a failure of the backend.
+#
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Generator, List, Optional
+
+from pydantic import BaseModel
+
+N_BACKEND_WORKERS = 32
+
+_executor = ThreadPoolExecutor(N_BACKEND_WORKERS, thread_name_prefix="backend")
+
+
+class BackendError(Exception):
+    pass
+
+
+class BackendTimeout(BackendError):
+    pass
+
+
+class BackendUnavailable(BackendError):
+    pass
+
+
+def is_key_conflict(err: BaseException) -> bool:
+    # Deta Base raises a plain `Exception` if the key of an `insert` is taken.
+    return "already exists" in str(err)
+
+
+#### ---- Policy ---- ####
+
+
+class CallPolicy:
+    def __init__(
+        self,
+        timeout: float = 5.0,
+        write_timeout: float = 10.0,
+        retries: int = 2,
+        backoff: float = 0.05,
+        max_backoff: float = 1.0,
+        hedge_percentile: Optional[float] = 95.0,
+        min_hedge_samples: int = 20,
+    ) -> None:
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_samples = min_hedge_samples
+
+    def backoff_delay(self, attempt: int) -> float:
+        # "Full jitter": a random delay up to the exponential backoff.
+        return random.random() * min(self.max_backoff, self.backoff * 2**attempt)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        # Once the reset timeout has passed, calls are let through again and the
+        # first result decides whether the breaker closes or opens again.
+        return self.state != "open"
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+#### ---- Metrics ---- ####
+
+
+class BackendStats(BaseModel):
+    state: str
+    calls: int
+    failures: int
+    timeouts: int
+    retries: int
+    hedges: int
+    hedge_wins: int
+    rejected: int
+    retry_rate: float
+    hedge_rate: float
+    p50_ms: Optional[float]
+    p95_ms: Optional[float]
+    p99_ms: Optional[float]
+
+
+class BackendMetrics:
+    def __init__(self, window: int = 500) -> None:
+        self.counts: Dict[str, int] = {
+            "calls": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "rejected": 0,
+        }
+        self.read_latencies: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def count(self, name: str, by: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += by
+
+    def add_read_latency(self, seconds: float) -> None:
+        with self._lock:
+            self.read_latencies.append(seconds)
+
+    def percentile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self.read_latencies)
+        if len(latencies) < max(min_samples, 1):
+            return None
+        index = min(int(q / 100 * len(latencies)), len(latencies) - 1)
+        return latencies[index]
+
+    def stats(self, state: str) -> BackendStats:
+        counts = dict(self.counts)
+        calls = max(counts["calls"], 1)
+        percentiles = {q: self.percentile(q) for q in (50, 95, 99)}
+        return BackendStats(
+            state=state,
+            retry_rate=counts["retries"] / calls,
+            hedge_rate=counts["hedges"] / calls,
+            p50_ms=_to_ms(percentiles[50]),
+            p95_ms=_to_ms(percentiles[95]),
+            p99_ms=_to_ms(percentiles[99]),
+            **counts,
+        )
+
+
+def _to_ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else seconds * 1000
+
+
+#### ---- Base ---- ####
+
+
+class ResilientBase:
+    def __init__(
+        self,
+        base: Any,
+        name: str,
+        policy: Optional[CallPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        self.base = base
+        self.name = name
+        self.policy = CallPolicy() if policy is None else policy
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.metrics = BackendMetrics()
+
+    def __getattr__(self, attr: str) -> Any:
+        # E.g. `util` for the update operations.
+        return getattr(self.base, attr)
+
+    def stats(self) -> BackendStats:
+        return self.metrics.stats(self.breaker.state)
+
+    def _check_breaker(self) -> None:
+        if not self.breaker.allow():
+            self.metrics.count("rejected")
+            raise BackendUnavailable(f"Backend '{self.name}' is unavailable.")
+
+    def _hedge_delay(self) -> Optional[float]:
+        if self.policy.hedge_percentile is None:
+            return None
+        return self.metrics.percentile(
+            self.policy.hedge_percentile, min_samples=self.policy.min_hedge_samples
+        )
+
+    def _attempt(
+        self, f: Callable[..., Any], args: Any, timeout: float, hedge: bool
+    ) -> Any:
+        # A timed out call cannot be cancelled; its worker thread is abandoned.
+        start = time.monotonic()
+        deadline = start + timeout
+        futures: List["Future[Any]"] = [_executor.submit(f, *args)]
+
+        hedge_delay = self._hedge_delay() if hedge else None
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                self.metrics.count("hedges")
+                futures.append(_executor.submit(f, *args))
+
+        error: Optional[BaseException] = None
+        pending = list(futures)
+        while pending:
+            remaining = deadline - time.monotonic()
+            done, _ = wait(
+                pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for future in done:
+                pending.remove(future)
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        self.metrics.count("hedge_wins")
+                    if hedge:
+                        self.metrics.add_read_latency(time.monotonic() - start)
+                    return future.result()
+                error = future.exception()
+
+        if error is None or pending:
+            self.metrics.count("timeouts")
+            raise BackendTimeout(
+                f"Call to backend '{self.name}' timed out after {timeout} seconds."
+            )
+        raise error
+
+    def _read(self, f: Callable[..., Any], *args: Any) -> Any:
+        self._check_breaker()
+        self.metrics.count("calls")
+        for attempt in range(self.policy.retries + 1):
+            if attempt > 0:
+                self.metrics.count("retries")
+                time.sleep(self.policy.backoff_delay(attempt - 1))
+                self._check_breaker()
+            try:
+                result = self._attempt(f, args, self.policy.timeout, hedge=True)
+            except Exception as err:
+                self.metrics.count("failures")
+                self.breaker.record_failure()
+                if attempt == self.policy.retries:
+                    raise err
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _write(
+        self,
+        f: Callable[..., Any],
+        *args: Any,
+        expected: Callable[[BaseException], bool] = lambda err: False,
+    ) -> Any:
+        self._check_breaker()
+        self.metrics.count("calls")
+        try:
+            result = self._attempt(f, args, self.policy.write_timeout, hedge=False)
+        except Exception as err:
+            if expected(err):
+                self.breaker.record_success()
+                raise
+            self.metrics.count("failures")
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._read(self.base.get, key)
+
+    def _fetch(
+        self,
+        query: Any = None,
+        buffer: Optional[int] = None,
+        last: Optional[str] = None,
+    ) -> Any:
+        return self._read(self.base._fetch, query, buffer, last)
+
+    def fetch(
+        self, query: Any = None, buffer: Optional[int] = None, pages: int = 10
+    ) -> Generator[List[Dict[str, Any]], None, None]:
+        # Same paging as `Base.fetch()`, with each page read through `_fetch()`.
+        last: Optional[str] = None
+        for _ in range(pages):
+            _, res = self._fetch(query, buffer, last)
+            yield res["items"]
+            last = res["paging"].get("last")
+            if last is None:
+                break
+
+    def put(self, data: Any, key: Optional[str] = None) -> Any:
+        return self._write(self.base.put, data, key)
+
+    def put_many(self, items: List[Any]) -> Any:
+        return self._write(self.base.put_many, items)
+
+    def insert(self, data: Any, key: Optional[str] = None) -> Any:
+        return self._write(self.base.insert, data, key, expected=is_key_conflict)
+
+    def update(self, updates: Dict[str, Any], key: str) -> Any:
+        return self._write(self.base.update, updates, key)
+
+    def delete(self, key: str) -> Any:
+        return self._write(self.base.delete, key)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the data helpers and endpoints.
+#
+# The Deta bases are replaced with in-memory stand-ins (see `local_base.py`)
+# seeded with synthetic bags and uses, so the results are reproducible and do
+# not depend on the network. Results are written as JSON so that runs from
+# different commits can be compared:
+#
+#   python benchmarks.py --sizes 1000 100000 --output new.json --compare old.json
+#
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+import formats
+import main
+from local_base import LocalBase
+from tests import gen_date, gen_datetime
+
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+USES_PER_BAG = 50
+N_ACTIVE_BAGS = 5
+
+
+#### ---- Synthetic data ---- ####
+
+
+def seed_databases(
+    n_uses: int, seed: int = 0, factory: Callable[[str], Any] = LocalBase
+) -> None:
+    random.seed(seed)
+    n_bags = max(N_ACTIVE_BAGS, n_uses // USES_PER_BAG)
+    main.use_base_factory(factory)
+
+    bag_ids: List[str] = []
+    bags: List[Dict[str, Any]] = []
+    for i in range(n_bags):
+        bag = main.CoffeeBag(
+            brand=f"Brand {i % 37}",
+            name=f"Coffee {i}",
+            start=gen_date(min_year=2015),
+            active=i >= n_bags - N_ACTIVE_BAGS,
+        )
+        bags.append(main.convert_bag_to_info(bag))
+        bag_ids.append(bag._key)
+    main.coffee_bag_db.put_many(bags)
+
+    # Build the records directly (matching `convert_use_to_info()`) because
+    # constructing a million models just to seed the data takes too long.
+    uses: List[Dict[str, Any]] = []
+    for _ in range(n_uses):
+        dt = gen_datetime(min_year=2015)
+        uses.append(
+            {
+                "key": main.make_key(),
+                "bag_id": random.choice(bag_ids),
+                "datetime": dt.isoformat(),
+                "_seconds": main.unix_time_millis(dt),
+                "_day": dt.date().isoformat(),
+            }
+        )
+    main.coffee_use_db.put_many(uses)
+
+    main.initialize_meta_db(bag_count=n_bags, use_count=n_uses)
+
+
+#### ---- Timing ---- ####
+
+
+def time_function(f: Callable[[], Any], repeat: int) -> List[float]:
+    times: List[float] = []
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(name: str, size: int, times: List[float]) -> Dict[str, Any]:
+    return {
+        "benchmark": name,
+        "size": size,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "runs": times,
+    }
+
+
+def benchmarks_for_size(n_uses: int) -> Dict[str, Callable[[], Any]]:
+    use_info = main.get_all_coffee_use_info()
+    uses = [main.convert_info_to_use(info) for info in use_info]
+    bag_id = use_info[0]["bag_id"]
+    last_month = datetime.now() - timedelta(days=30)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        query_result = main.query_coffee_uses_db(n_last=10_000)
+
+    benchmarks: Dict[str, Callable[[], Any]] = {
+        "convert_info_to_use": lambda: [main.convert_info_to_use(i) for i in use_info],
+        "keyedlist_to_dict": lambda: main.keyedlist_to_dict(uses),
+        "query_coffee_uses_db[all]": lambda: main.query_coffee_uses_db(),
+        "query_coffee_uses_db[n_last=100]": lambda: main.query_coffee_uses_db(
+            n_last=100
+        ),
+        "query_coffee_uses_db[since=30d]": lambda: main.query_coffee_uses_db(
+            since=last_month
+        ),
+        "query_coffee_uses_db[bag_id]": lambda: main.query_coffee_uses_db(
+            bag_id=bag_id
+        ),
+        "get_active_bags": lambda: main.get_active_bags(n_last=None),
+        "get_number_of_uses": lambda: main.get_number_of_uses(),
+        "get_number_of_uses[since=30d]": lambda: main.get_number_of_uses(
+            since=last_month
+        ),
+        "get_dashboard": lambda: asyncio.run(main.get_dashboard(n_last=10)),
+        "json_encoding[n_last=10000]": lambda: json.dumps(
+            jsonable_encoder(query_result)
+        ),
+        "columnar_json_encoding[n_last=10000]": lambda: formats.encode_columns(
+            formats.use_columns(query_result.values()), formats.COLUMNAR_JSON
+        ),
+    }
+    if formats.msgpack is not None:
+        benchmarks["msgpack_encoding[n_last=10000]"] = lambda: formats.encode_columns(
+            formats.use_columns(query_result.values()), formats.MSGPACK
+        )
+    return benchmarks
+
+
+#### ---- Startup ---- ####
+
+# Run in a fresh interpreter to measure the cold start: the time to import the
+# app and the time until the first response has been produced.
+STARTUP_SCRIPT = """
+import asyncio, json, time
+
+start = time.perf_counter()
+import main
+import_s = time.perf_counter() - start
+
+from load_test import asgi_sender
+from local_base import LocalBase
+
+main.use_base_factory(LocalBase)
+send_request = asgi_sender(main.app)
+start = time.perf_counter()
+status = asyncio.run(send_request("GET", "/active_bags/"))
+first_request_s = time.perf_counter() - start
+
+print(json.dumps({"import": import_s, "first_response": import_s + first_request_s}))
+"""
+
+
+def startup_times(repeat: int) -> Dict[str, List[float]]:
+    env = dict(os.environ, WARM_UP_ON_STARTUP="0")
+    times: Dict[str, List[float]] = {"import": [], "first_response": []}
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        for name, value in result.items():
+            times[name].append(value)
+    return times
+
+
+def run_benchmarks(
+    sizes: List[int], repeat: int, only: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    startup = ["startup[import]", "startup[first_response]"]
+    if only is None or any(o in name for o in only for name in startup):
+        for name, times in startup_times(repeat=max(repeat, 5)).items():
+            result = summarize(f"startup[{name}]", 0, times)
+            print(f"  {result['benchmark']:<36} {result['median_s'] * 1000:>12.2f} ms")
+            results.append(result)
+
+    for size in sizes:
+        print(f"Seeding {size} uses...")
+        seed_databases(size)
+        for name, f in benchmarks_for_size(size).items():
+            if only is not None and not any(o in name for o in only):
+                continue
+            result = summarize(name, size, time_function(f, repeat=repeat))
+            print(f"  {name:<36} {result['median_s'] * 1000:>12.2f} ms")
+            results.append(result)
+    return results
+
+
+#### ---- Reporting ---- ####
+
+
+def current_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def compare_results(new: Dict[str, Any], old: Dict[str, Any]) -> None:
+    previous = {(r["benchmark"], r["size"]): r for r in old["results"]}
+    print(f"Comparing against {old.get('commit')}:")
+    for result in new["results"]:
+        other = previous.get((result["benchmark"], result["size"]))
+        if other is None:
+            continue
+        ratio = result["median_s"] / other["median_s"]
+        print(
+            f"  {result['benchmark']:<36} {result['size']:>9} "
+            f"{other['median_s'] * 1000:>12.2f} ms -> "
+            f"{result['median_s'] * 1000:>12.2f} ms  ({ratio:.2f}x)"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the data helpers.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--only", type=str, nargs="+", help="Only run benchmarks matching a name."
+    )
+    parser.add_argument("--output", type=str, default="benchmark_results.json")
+    parser.add_argument("--compare", type=str, help="Results file to compare to.")
+    return parser.parse_args()
+
+
+def main_cli() -> None:
+    args = parse_args()
+    results = {
+        "commit": current_commit(),
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": run_benchmarks(args.sizes, repeat=args.repeat, only=args.only),
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to '{args.output}'.")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            compare_results(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main_cli()
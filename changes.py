@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# An append-only log of the changes to the bags and uses for clients that
+# mirror the data and only want what changed since their last sync.
+#
+# Every put, update and delete is recorded under a monotonically increasing
+# sequence number. The zero-padded number is the key of the record, so Deta
+# Base returns the log in order and a client pages through it with the last
+# sequence number it has seen. Deletions are recorded as tombstones without
+# data.
+#
+# Sequence numbers are the time of the change in milliseconds times 1000 plus
+# a counter, handed out in blocks of 25 (the most `put_many()` writes at once).
+# Deta Base has no atomic counter, so the log itself is the counter that all
+# writers share: a block is claimed by inserting the record of its first
+# number, which fails if another writer has taken it, and a later block is
+# tried. The other changes of the block are then written with `put_many()`.
+#
+# Writers still commit their numbers out of order (a slow write can land after a
+# later number was read), so only changes older than `delay` seconds are
+# served. The delay has to cover the time a write may take plus the clock skew
+# between instances.
+#
+# A change that cannot be recorded (the data it describes is already written)
+# is kept and recorded with the next batch, or before the log is read.
+#
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+from backend import BackendError
+from events import ChangeOp, Collection
+
+SEQ_WIDTH = 20
+SEQ_BLOCK = 25
+CLAIM_ATTEMPTS = 10
+N_PARALLEL_PUTS = 8
+
+
+class Change(BaseModel):
+    seq: int
+    collection: Collection
+    op: ChangeOp
+    key: str
+    data: Optional[Dict[str, Any]] = None
+    time: datetime
+
+
+class ChangePage(BaseModel):
+    changes: List[Change]
+    last: int
+    more: bool
+
+
+class SequenceGenerator:
+    def __init__(self, clock: Callable[[], float] = time.time) -> None:
+        self.clock = clock
+        self._last = 0
+        self._lock = Lock()
+
+    def next_block(self) -> int:
+        # The first number of a block that no earlier number was taken from.
+        with self._lock:
+            seq = max(int(self.clock() * 1000) * 1000, self._last + 1)
+            block = -(-seq // SEQ_BLOCK) * SEQ_BLOCK
+            self._last = block + SEQ_BLOCK - 1
+        return block
+
+    def advance(self, seq: int) -> None:
+        # The next number will be greater than `seq`.
+        with self._lock:
+            self._last = max(self._last, seq)
+
+
+def sequence_at(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000) * 1000
+
+
+def seq_key(seq: int) -> str:
+    return str(seq).zfill(SEQ_WIDTH)
+
+
+def change_to_record(change: Change) -> Dict[str, Any]:
+    # The record's `key` is the sequence number, so the key of the changed item
+    # is stored as `item_key`.
+    record = jsonable_encoder(change)
+    record["item_key"] = record.pop("key")
+    record["key"] = seq_key(change.seq)
+    return record
+
+
+def record_to_change(record: Dict[str, Any]) -> Change:
+    record = dict(record)
+    record.pop("key")
+    record["key"] = record.pop("item_key")
+    return Change(**record)
+
+
+class ChangeLogError(Exception):
+    pass
+
+
+class ChangeLog:
+    def __init__(
+        self,
+        db: Any,
+        sequence: Optional[SequenceGenerator] = None,
+        delay: float = 15.0,
+    ) -> None:
+        self.db = db
+        self.sequence = SequenceGenerator() if sequence is None else sequence
+        self.delay = delay
+        # Changes yet to be recorded, with the (tenant's) base they go to.
+        self._pending: List[Tuple[Any, List[Change]]] = []
+        self._pending_lock = Lock()
+        self._flush_lock = Lock()
+
+    def _base(self) -> Any:
+        # A partitioned base is resolved for the current tenant before it is
+        # used from worker threads.
+        resolve = getattr(self.db, "resolve", None)
+        return self.db if resolve is None else resolve()
+
+    def _claim(self, db: Any, change: Change) -> int:
+        # Claims a block by inserting its first change; returns the block.
+        for attempt in range(CLAIM_ATTEMPTS):
+            block = self.sequence.next_block()
+            change.seq = block
+            record = change_to_record(change)
+            try:
+                db.insert(record)
+                return block
+            except BackendError:
+                raise
+            except Exception:
+                existing = db.get(record["key"])
+                if existing is None:
+                    raise
+                if existing == record:
+                    # The insert went through before the error.
+                    return block
+                # Skip further ahead after each conflict to get past the blocks
+                # another writer is taking.
+                self.sequence.advance(block + SEQ_BLOCK * 2**attempt - 1)
+        raise ChangeLogError(f"No free sequence block after {CLAIM_ATTEMPTS} attempts.")
+
+    def _write(self, db: Any, changes: List[Change]) -> None:
+        # The blocks are claimed in order, then filled in parallel.
+        batches: List[List[Dict[str, Any]]] = []
+        for i in range(0, len(changes), SEQ_BLOCK):
+            block_changes = changes[i : i + SEQ_BLOCK]
+            block = self._claim(db, block_changes[0])
+            for n, change in enumerate(block_changes[1:], start=1):
+                change.seq = block + n
+            if len(block_changes) > 1:
+                batches.append([change_to_record(c) for c in block_changes[1:]])
+        if len(batches) == 1:
+            db.put_many(batches[0])
+        elif len(batches) > 1:
+            with ThreadPoolExecutor(N_PARALLEL_PUTS) as executor:
+                list(executor.map(db.put_many, batches))
+
+    def flush(self) -> bool:
+        # Records the pending changes in order. Concurrent callers wait for the
+        # flush in progress, which has taken their changes as well.
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            failed: List[Tuple[Any, List[Change]]] = []
+            for db, changes in pending:
+                if any(failed_db is db for failed_db, _ in failed):
+                    # Kept behind the earlier changes of the same log.
+                    failed.append((db, changes))
+                    continue
+                try:
+                    self._write(db, changes)
+                except Exception as err:
+                    # Recorded later under new (greater) sequence numbers, so
+                    # no client has read past them. A change whose record did
+                    # go through may then appear twice.
+                    print(
+                        f"Recording {len(changes)} changes failed (will retry): {err}"
+                    )
+                    failed.append((db, changes))
+            with self._pending_lock:
+                self._pending = failed + self._pending
+        return len(failed) == 0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(changes) for _, changes in self._pending)
+
+    def record(
+        self,
+        collection: Collection,
+        op: ChangeOp,
+        items: List[Tuple[str, Optional[Dict[str, Any]]]],
+    ) -> List[Change]:
+        now = datetime.now()
+        changes = [
+            Change(
+                seq=0,
+                collection=collection,
+                op=op,
+                key=key,
+                data=None if op == ChangeOp.delete else data,
+                time=now,
+            )
+            for key, data in items
+        ]
+        with self._pending_lock:
+            self._pending.append((self._base(), changes))
+        self.flush()
+        return changes
+
+    def watermark(self) -> int:
+        # The last sequence number that can be served.
+        return int((time.time() - self.delay) * 1000) * 1000 + 999
+
+    def read(self, after: int = 0, limit: int = 1000) -> ChangePage:
+        self.flush()
+        watermark = self.watermark()
+        last = None if after <= 0 else seq_key(after)
+        _, res = self.db._fetch(query=None, buffer=limit, last=last)
+        changes: List[Change] = []
+        more = res["paging"].get("last") is not None
+        for record in res["items"]:
+            change = record_to_change(record)
+            if change.seq > watermark:
+                more = False
+                break
+            changes.append(change)
+        return ChangePage(
+            changes=changes,
+            last=changes[-1].seq if len(changes) > 0 else after,
+            more=more,
+        )
@@ -27,9 +27,27 @@ def add_seconds_attribute_to_coffee_uses():
     print(f"Converted {n} uses.")
 
 
+def add_day_attribute_to_coffee_uses():
+    coffee_uses = main.coffee_use_dict()
+    n = 0
+    for key, coffee_use in coffee_uses.items():
+        try:
+            main.coffee_use_db.update({"_day": coffee_use._day}, key=key)
+            n += 1
+        except Exception as err:
+            print(f"Error: {err}")
+            print("CoffeeUse:")
+            print(coffee_use.dict())
+            return
+    # Only use the day buckets for queries once every use has one.
+    main.meta_db.update({main.MetaDataField.day_index: True}, key=main.META_DB_KEY)
+    print(f"Converted {n} uses.")
+
+
 def migrate():
     # introduce_active_attribute_to_coffee_bags()
     # add_seconds_attribute_to_coffee_uses()
+    # add_day_attribute_to_coffee_uses()
     print("Done")
 
 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# In-process publish/subscribe of changes to the bags and uses.
+#
+# Write endpoints publish a `ChangeEvent` for every bag or use that they put,
+# update or delete. Events are handed to synchronous listeners and delivered to
+# every connected subscriber (e.g. a Server-Sent Events stream) through a
+# bounded queue. Subscribers only receive the events of their own tenant (see
+# `tenants.py`). A subscriber that falls behind loses its oldest events and is
+# told how many were dropped, so a slow client never blocks the writers.
+#
+
+import asyncio
+import itertools
+import json
+from datetime import datetime
+from enum import Enum
+from threading import Lock
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Set
+
+from pydantic import BaseModel
+
+SUBSCRIBER_QUEUE_SIZE = 100
+HEARTBEAT_SECONDS = 15.0
+
+
+class Collection(str, Enum):
+    bags = "bags"
+    uses = "uses"
+
+
+class ChangeOp(str, Enum):
+    put = "put"
+    update = "update"
+    delete = "delete"
+
+
+class ChangeEvent(BaseModel):
+    id: int
+    collection: Collection
+    op: ChangeOp
+    key: str
+    data: Optional[Dict[str, Any]] = None
+    time: datetime
+    tenant: Optional[str] = None
+
+
+Listener = Callable[[ChangeEvent], None]
+
+
+#### ---- Subscriptions ---- ####
+
+
+class Subscription:
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        maxsize: int,
+        tenant: Optional[str] = None,
+    ) -> None:
+        self.loop = loop
+        self.tenant = tenant
+        self.queue: "asyncio.Queue[ChangeEvent]" = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def deliver(self, event: ChangeEvent) -> None:
+        # Must run in the subscriber's event loop.
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+
+class Broadcaster:
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE) -> None:
+        self.queue_size = queue_size
+        self._subscriptions: Set[Subscription] = set()
+        self._listeners: List[Listener] = []
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+
+    @property
+    def n_subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    def subscribe(self, tenant: Optional[str] = None) -> Subscription:
+        subscription = Subscription(
+            asyncio.get_event_loop(), maxsize=self.queue_size, tenant=tenant
+        )
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def add_listener(self, listener: Listener) -> None:
+        with self._lock:
+            self._listeners.append(listener)
+
+    def publish(
+        self,
+        collection: Collection,
+        op: ChangeOp,
+        key: str,
+        data: Optional[Dict[str, Any]] = None,
+        tenant: Optional[str] = None,
+    ) -> ChangeEvent:
+        with self._lock:
+            event = ChangeEvent(
+                id=next(self._ids),
+                collection=collection,
+                op=op,
+                key=key,
+                data=data,
+                time=datetime.now(),
+                tenant=tenant,
+            )
+            listeners = list(self._listeners)
+            subscriptions = [s for s in self._subscriptions if s.tenant == tenant]
+
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as err:
+                print(f"Change listener failed: {err}")
+
+        # Publishers may run in a worker thread, so the event is handed over to
+        # the loop that owns each subscriber's queue.
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # The subscriber's loop has been closed.
+                self.unsubscribe(subscription)
+        return event
+
+
+#### ---- Server-Sent Events ---- ####
+
+
+def format_sse(event: str, data: str, id: Optional[int] = None) -> str:
+    message = "" if id is None else f"id: {id}\n"
+    return message + f"event: {event}\ndata: {data}\n\n"
+
+
+async def event_stream(
+    broadcaster: Broadcaster,
+    heartbeat: float = HEARTBEAT_SECONDS,
+    tenant: Optional[str] = None,
+) -> AsyncGenerator[str, None]:
+    subscription = broadcaster.subscribe(tenant=tenant)
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    subscription.queue.get(), timeout=heartbeat
+                )
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle connection.
+                yield ": heartbeat\n\n"
+                continue
+            if subscription.dropped > 0:
+                dropped = json.dumps({"dropped": subscription.dropped})
+                subscription.dropped = 0
+                yield format_sse("lagged", dropped)
+            yield format_sse(event.collection.value, event.json(), id=event.id)
+    finally:
+        broadcaster.unsubscribe(subscription)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Response formats for the listings of bags and uses.
+#
+# Besides the default JSON object keyed by id, clients can ask (with the
+# `Accept` header) for a columnar layout with one array per field:
+#
+#   application/vnd.coffee-counter.columnar+json   columns as JSON
+#   application/msgpack                            columns as MessagePack
+#
+# Uses are listed with their time in milliseconds since the epoch. MessagePack
+# is only offered if the optional `msgpack` package is installed.
+#
+
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from starlette.middleware.gzip import GZipMiddleware
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.coffee-counter.columnar+json"
+MSGPACK = "application/msgpack"
+
+MEDIA_TYPE_ALIASES = {"application/x-msgpack": MSGPACK}
+
+Columns = Dict[str, List[Any]]
+
+
+def available_formats() -> List[str]:
+    formats = [JSON, COLUMNAR_JSON]
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    return formats
+
+
+#### ---- Content negotiation ---- ####
+
+
+def parse_accept(accept: str) -> List[Tuple[str, float]]:
+    media_ranges: List[Tuple[str, float]] = []
+    for part in accept.split(","):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        if media_type == "":
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media_type = media_type.lower()
+        media_ranges.append((MEDIA_TYPE_ALIASES.get(media_type, media_type), q))
+    return media_ranges
+
+
+def _quality(media_type: str, media_ranges: List[Tuple[str, float]]) -> float:
+    # The most specific matching media range decides.
+    main_type = media_type.split("/")[0]
+    best: Tuple[int, float] = (-1, 0.0)
+    for media_range, q in media_ranges:
+        if media_range == media_type:
+            specificity = 2
+        elif media_range == f"{main_type}/*":
+            specificity = 1
+        elif media_range == "*/*":
+            specificity = 0
+        else:
+            continue
+        if specificity > best[0]:
+            best = (specificity, q)
+    return best[1]
+
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    # Returns the preferred available format, JSON on a tie, or None if the
+    # client accepts none of them.
+    if accept is None or accept.strip() == "":
+        return JSON
+    media_ranges = parse_accept(accept)
+    best: Optional[str] = None
+    best_q = 0.0
+    for media_type in available_formats():
+        q = _quality(media_type, media_ranges)
+        if q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+#### ---- Columns ---- ####
+
+
+def bag_columns(bags: Iterable[Any]) -> Columns:
+    columns: Columns = {
+        "key": [],
+        "brand": [],
+        "name": [],
+        "weight": [],
+        "start": [],
+        "finish": [],
+        "active": [],
+    }
+    for bag in bags:
+        columns["key"].append(bag._key)
+        columns["brand"].append(bag.brand)
+        columns["name"].append(bag.name)
+        columns["weight"].append(bag.weight)
+        columns["start"].append(None if bag.start is None else bag.start.isoformat())
+        columns["finish"].append(None if bag.finish is None else bag.finish.isoformat())
+        columns["active"].append(bag.active)
+    return columns
+
+
+def use_columns(uses: Iterable[Any]) -> Columns:
+    columns: Columns = {"key": [], "bag_id": [], "timestamp_ms": []}
+    for use in uses:
+        columns["key"].append(use._key)
+        columns["bag_id"].append(use.bag_id)
+        columns["timestamp_ms"].append(int(use._seconds))
+    return columns
+
+
+def encode_columns(columns: Columns, media_type: str) -> bytes:
+    if media_type == MSGPACK:
+        return msgpack.packb(columns, use_bin_type=True)
+    return json.dumps(columns, separators=(",", ":")).encode()
+
+
+ColumnsFunction = Callable[[Iterable[Any]], Columns]
+
+
+#### ---- Compression ---- ####
+
+
+class CompressionMiddleware:
+    # Gzip for clients that accept it, except for paths whose responses are
+    # streamed (Server-Sent Events) or already compressed (the snapshot).
+    def __init__(
+        self, app: Any, minimum_size: int = 1000, exclude_paths: Iterable[str] = ()
+    ) -> None:
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+        self.exclude_paths = set(exclude_paths)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http" and scope["path"] not in self.exclude_paths:
+            await self.gzip(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# A load generator for the API.
+#
+# A fleet of concurrent clients issues a weighted mix of requests (polling the
+# active bags, logging new uses, pulling recent uses for the dashboard) and the
+# throughput, latency percentiles and error rates are reported per endpoint.
+# By default the app is driven in-process through ASGI with the Deta bases
+# replaced by in-memory stand-ins that can inject latency. Alternatively, the
+# same traffic can be sent over HTTP to a local uvicorn server (`--serve`) or
+# to any running deployment (`--url`).
+#
+#   python load_test.py --concurrency 50 --duration 30 --latency 0.05
+#   python load_test.py --mix active_bags=90,new_use=10 --serve
+#
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from math import ceil
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import main
+from backend import ResilientBase
+from benchmarks import seed_databases
+from local_base import LocalBase
+
+LOAD_TEST_PASSWORD = "load-test-password"
+DEFAULT_MIX = "active_bags=70,new_use=10,uses=15,number_of_uses=5"
+
+Request = Tuple[str, str]  # (method, path with query)
+Sender = Callable[[str, str], Awaitable[int]]
+
+
+#### ---- Traffic ---- ####
+
+REQUEST_TYPES = [
+    "active_bags",
+    "new_use",
+    "uses",
+    "number_of_uses",
+    "bags",
+    "dashboard",
+]
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights: Dict[str, float] = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name not in REQUEST_TYPES:
+            raise ValueError(f"Unknown request type '{name}'.")
+        weights[name] = float(weight)
+    return weights
+
+
+def make_request(name: str, bag_ids: List[str], password: str) -> Request:
+    if name == "active_bags":
+        return "GET", "/active_bags/"
+    if name == "new_use":
+        return "PUT", f"/new_use/{random.choice(bag_ids)}?password={password}"
+    if name == "uses":
+        return "GET", "/uses/?n_last=100"
+    if name == "number_of_uses":
+        return "GET", "/number_of_uses/"
+    if name == "dashboard":
+        return "GET", "/dashboard/"
+    if name == "bags":
+        return "GET", "/bags/"
+    raise ValueError(f"Unknown request type '{name}'.")
+
+
+#### ---- Senders ---- ####
+
+
+def asgi_sender(app: Any) -> Sender:
+    async def send_request(method: str, path: str) -> int:
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": query.encode(),
+            "headers": [(b"host", b"load-test")],
+            "client": ("127.0.0.1", 0),
+            "server": ("load-test", 80),
+        }
+        status = 0
+
+        async def receive() -> Dict[str, Any]:
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        await app(scope, receive, send)
+        return status
+
+    return send_request
+
+
+def http_sender(base_url: str, concurrency: int) -> Sender:
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def blocking_request(method: str, path: str) -> int:
+        request = urllib.request.Request(base_url + path, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as err:
+            return err.code
+
+    async def send_request(method: str, path: str) -> int:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, blocking_request, method, path)
+
+    return send_request
+
+
+def start_uvicorn(port: int) -> None:
+    import uvicorn
+
+    config = uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+
+#### ---- Clients ---- ####
+
+
+class Results:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, name: str, latency: float, ok: bool) -> None:
+        self.latencies.setdefault(name, []).append(latency)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+async def client(
+    send_request: Sender,
+    weights: Dict[str, float],
+    bag_ids: List[str],
+    password: str,
+    deadline: float,
+    results: Results,
+) -> None:
+    names = list(weights.keys())
+    name_weights = list(weights.values())
+    while time.perf_counter() < deadline:
+        name = random.choices(names, weights=name_weights)[0]
+        method, path = make_request(name, bag_ids, password)
+        start = time.perf_counter()
+        try:
+            status = await send_request(method, path)
+        except Exception:
+            status = 0
+        results.record(name, time.perf_counter() - start, ok=200 <= status < 300)
+
+
+async def run_load(
+    send_request: Sender,
+    weights: Dict[str, float],
+    bag_ids: List[str],
+    password: str,
+    concurrency: int,
+    duration: float,
+) -> Tuple[Results, float]:
+    results = Results()
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(
+        *[
+            client(send_request, weights, bag_ids, password, deadline, results)
+            for _ in range(concurrency)
+        ]
+    )
+    return results, time.perf_counter() - start
+
+
+#### ---- Reporting ---- ####
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    rank = max(ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(results: Results, elapsed: float) -> Dict[str, Dict[str, float]]:
+    summary: Dict[str, Dict[str, float]] = {}
+    all_latencies: List[float] = []
+    for name, latencies in results.latencies.items():
+        all_latencies += latencies
+        errors = results.errors.get(name, 0)
+        summary[name] = _summarize_latencies(latencies, errors, elapsed)
+    if all_latencies:
+        summary["total"] = _summarize_latencies(
+            all_latencies, sum(results.errors.values()), elapsed
+        )
+    return summary
+
+
+def _summarize_latencies(
+    latencies: List[float], errors: int, elapsed: float
+) -> Dict[str, float]:
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "error_rate": errors / len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000,
+    }
+
+
+def print_summary(summary: Dict[str, Dict[str, float]]) -> None:
+    print(
+        f"{'endpoint':<16} {'requests':>9} {'req/s':>9} {'errors':>8} "
+        f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    )
+    for name, s in summary.items():
+        print(
+            f"{name:<16} {s['requests']:>9.0f} {s['requests_per_second']:>9.1f} "
+            f"{s['error_rate']:>8.2%} {s['p50_ms']:>9.1f} {s['p90_ms']:>9.1f} "
+            f"{s['p99_ms']:>9.1f} {s['max_ms']:>9.1f}"
+        )
+
+
+#### ---- Setup ---- ####
+
+
+def setup_local_backend(
+    n_uses: int, latency: float, jitter: float, resilient: bool = False
+) -> None:
+    def factory(name: str) -> Any:
+        base = LocalBase(name, latency=latency, jitter=jitter)
+        if resilient:
+            return ResilientBase(base, name=name, policy=main.backend_policy)
+        return base
+
+    seed_databases(n_uses, factory=factory)
+    main.HASHED_PASSWORD = main.get_pwd_context().hash(LOAD_TEST_PASSWORD)
+
+
+def fetch_active_bag_ids(url: Optional[str]) -> List[str]:
+    if url is None:
+        return list(main.get_active_bags(n_last=None).keys())
+    with urllib.request.urlopen(url + "/active_bags/", timeout=30) as response:
+        return list(json.loads(response.read()).keys())
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the API.")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds.")
+    parser.add_argument("--mix", type=str, default=DEFAULT_MIX)
+    parser.add_argument("--uses", type=int, default=10_000, help="Seeded uses.")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Backend latency (seconds)."
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random extra backend latency."
+    )
+    parser.add_argument(
+        "--resilient",
+        action="store_true",
+        help="Wrap the in-memory bases with timeouts, retries and hedging.",
+    )
+    parser.add_argument(
+        "--serve", action="store_true", help="Send requests over a local uvicorn."
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--url", type=str, help="Load test a running server instead (no seeding)."
+    )
+    parser.add_argument("--password", type=str, default=LOAD_TEST_PASSWORD)
+    parser.add_argument("--output", type=str, help="Write the summary as JSON.")
+    return parser.parse_args()
+
+
+def main_cli() -> None:
+    args = parse_args()
+    weights = parse_mix(args.mix)
+
+    url: Optional[str] = args.url
+    if url is None:
+        setup_local_backend(
+            args.uses,
+            latency=args.latency,
+            jitter=args.jitter,
+            resilient=args.resilient,
+        )
+        if args.serve:
+            start_uvicorn(args.port)
+            url = f"http://127.0.0.1:{args.port}"
+
+    send_request = (
+        asgi_sender(main.app) if url is None else http_sender(url, args.concurrency)
+    )
+    bag_ids = fetch_active_bag_ids(args.url)
+
+    # Silence the API's own logging while the clients are running.
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        results, elapsed = asyncio.run(
+            run_load(
+                send_request,
+                weights,
+                bag_ids=bag_ids,
+                password=args.password,
+                concurrency=args.concurrency,
+                duration=args.duration,
+            )
+        )
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    if args.url is None and args.resilient:
+        for name, stats in main.get_backend_metrics(args.password).items():
+            print(f"{name}: {stats.json()}")
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
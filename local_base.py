@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# An in-memory stand-in for the Deta `Base` API (as used by `main.py`).
+#
+# Items are kept in a dictionary and paged in key order just like Deta Base,
+# including the `_fetch()` cursor protocol behind `fetch()` and the `util`
+# update operations. An artificial per-call latency can be injected to imitate
+# the network round trip to Deta.
+#
+
+import random
+import time
+import uuid
+from bisect import bisect_right
+from threading import Lock
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+
+Query = Union[Dict[str, Any], List[Dict[str, Any]]]
+
+
+#### ---- Update operations ---- ####
+
+
+class Util:
+    class Trim:
+        pass
+
+    class Increment:
+        def __init__(self, value: Union[int, float, None] = None) -> None:
+            self.val = 1 if value is None else value
+
+    class Append:
+        def __init__(self, value: Any) -> None:
+            self.val = value if isinstance(value, list) else [value]
+
+    class Prepend:
+        def __init__(self, value: Any) -> None:
+            self.val = value if isinstance(value, list) else [value]
+
+    def trim(self) -> "Util.Trim":
+        return self.Trim()
+
+    def increment(self, value: Union[int, float, None] = None) -> "Util.Increment":
+        return self.Increment(value)
+
+    def append(self, value: Any) -> "Util.Append":
+        return self.Append(value)
+
+    def prepend(self, value: Any) -> "Util.Prepend":
+        return self.Prepend(value)
+
+
+#### ---- Queries ---- ####
+
+
+def _get_field(item: Dict[str, Any], path: str) -> Any:
+    value: Any = item
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _compare(value: Any, op: str, target: Any) -> bool:
+    if op == "ne":
+        return value != target
+    if value is None:
+        return False
+    try:
+        if op == "lt":
+            return value < target
+        if op == "gt":
+            return value > target
+        if op == "lte":
+            return value <= target
+        if op == "gte":
+            return value >= target
+        if op == "r":
+            return target[0] <= value <= target[1]
+    except TypeError:
+        return False
+    if op == "pfx":
+        return isinstance(value, str) and value.startswith(target)
+    if op == "contains":
+        return target in value
+    if op == "not_contains":
+        return target not in value
+    raise ValueError(f"Unknown query operator '{op}'.")
+
+
+def _matches_conditions(item: Dict[str, Any], conditions: Dict[str, Any]) -> bool:
+    for field, target in conditions.items():
+        if "?" in field:
+            field, op = field.rsplit("?", 1)
+            if not _compare(_get_field(item, field), op, target):
+                return False
+        elif _get_field(item, field) != target:
+            return False
+    return True
+
+
+def matches_query(item: Dict[str, Any], query: Optional[Query]) -> bool:
+    if not query:
+        return True
+    if isinstance(query, dict):
+        return _matches_conditions(item, query)
+    return any(_matches_conditions(item, q) for q in query)
+
+
+#### ---- Base ---- ####
+
+
+class LocalBase:
+    def __init__(self, name: str, latency: float = 0.0, jitter: float = 0.0) -> None:
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.util = Util()
+        self._items: Dict[str, Dict[str, Any]] = {}
+        self._sorted_keys: Optional[List[str]] = None
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _round_trip(self) -> None:
+        if self.latency > 0 or self.jitter > 0:
+            time.sleep(self.latency + self.jitter * random.random())
+
+    def _keys(self) -> List[str]:
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self._items.keys())
+        return self._sorted_keys
+
+    def _put(self, data: Dict[str, Any], key: Optional[str] = None) -> Dict[str, Any]:
+        item = dict(data)
+        if key is not None:
+            item["key"] = key
+        if item.get("key") is None:
+            item["key"] = uuid.uuid4().hex[:12]
+        if item["key"] not in self._items:
+            self._sorted_keys = None
+        self._items[item["key"]] = item
+        return dict(item)
+
+    def put(self, data: Dict[str, Any], key: Optional[str] = None) -> Dict[str, Any]:
+        self._round_trip()
+        with self._lock:
+            return self._put(data, key=key)
+
+    def put_many(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        self._round_trip()
+        with self._lock:
+            return {"processed": {"items": [self._put(item) for item in items]}}
+
+    def insert(self, data: Dict[str, Any], key: Optional[str] = None) -> Dict[str, Any]:
+        self._round_trip()
+        with self._lock:
+            key = data.get("key") if key is None else key
+            if key is not None and key in self._items:
+                raise Exception(f"Item with key '{key}' already exists")
+            return self._put(data, key=key)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        self._round_trip()
+        item = self._items.get(key)
+        return None if item is None else dict(item)
+
+    def delete(self, key: str) -> None:
+        self._round_trip()
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self._sorted_keys = None
+        return None
+
+    def update(self, updates: Dict[str, Any], key: str) -> None:
+        self._round_trip()
+        with self._lock:
+            if key not in self._items:
+                raise Exception(f"Key '{key}' not found")
+            item = dict(self._items[key])
+            for field, value in updates.items():
+                if isinstance(value, Util.Trim):
+                    item.pop(field, None)
+                elif isinstance(value, Util.Increment):
+                    item[field] = item.get(field, 0) + value.val
+                elif isinstance(value, Util.Append):
+                    item[field] = list(item.get(field, [])) + value.val
+                elif isinstance(value, Util.Prepend):
+                    item[field] = value.val + list(item.get(field, []))
+                else:
+                    item[field] = value
+            self._items[key] = item
+        return None
+
+    def _fetch(
+        self,
+        query: Optional[Query] = None,
+        buffer: Optional[int] = None,
+        last: Optional[str] = None,
+    ) -> Tuple[int, Dict[str, Any]]:
+        self._round_trip()
+        with self._lock:
+            keys = self._keys()
+            start = 0 if last is None else bisect_right(keys, last)
+            items: List[Dict[str, Any]] = []
+            next_last: Optional[str] = None
+            for i in range(start, len(keys)):
+                item = self._items[keys[i]]
+                if not matches_query(item, query):
+                    continue
+                if buffer is not None and len(items) == buffer:
+                    next_last = items[-1]["key"]
+                    break
+                items.append(dict(item))
+        paging: Dict[str, Any] = {"size": len(items)}
+        if next_last is not None:
+            paging["last"] = next_last
+        return 200, {"paging": paging, "items": items}
+
+    def fetch(
+        self,
+        query: Optional[Query] = None,
+        buffer: Optional[int] = None,
+        pages: int = 10,
+    ) -> Generator[List[Dict[str, Any]], None, None]:
+        last: Optional[str] = None
+        for _ in range(pages):
+            _, res = self._fetch(query, buffer, last)
+            yield res["items"]
+            last = res["paging"].get("last")
+            if last is None:
+                break
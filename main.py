@@ -1,46 +1,268 @@
 #!/usr/bin/env python3
 
+import asyncio
+import json
 import os
+import threading
 import uuid
-from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from enum import Enum
-from math import ceil
-from typing import Any, Dict, List, Optional, TypeVar
-
-from deta import Deta
-from deta.base import Base
-from fastapi import FastAPI, HTTPException, Query, status
+from functools import lru_cache
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NoReturn,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
-from passlib.context import CryptContext
-from pydantic import BaseModel
-from pydantic.errors import NoneIsNotAllowedError
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from pydantic.fields import PrivateAttr
 
+from archive import LocalDrive, SegmentArchive
+from backend import (
+    BackendError,
+    BackendStats,
+    BackendTimeout,
+    BackendUnavailable,
+    CallPolicy,
+    CircuitBreaker,
+    ResilientBase,
+)
+from changes import ChangeLog, ChangePage
+from events import Broadcaster, ChangeEvent, ChangeOp, Collection, event_stream
+from formats import (
+    COLUMNAR_JSON,
+    JSON,
+    MSGPACK,
+    ColumnsFunction,
+    CompressionMiddleware,
+    available_formats,
+    bag_columns,
+    encode_columns,
+    negotiate,
+    use_columns,
+)
+from paging import DEFAULT_BUFFER, Page, iter_pages, iter_records
+from profiler import (
+    ProfiledRoute,
+    ProfilingMiddleware,
+    RequestProfile,
+    phase,
+    profile_store,
+)
+from search import BagIndex
+from shared_cache import CacheStats, LocalCache, SharedCache
+from snapshot import (
+    Snapshot,
+    SnapshotMaterializer,
+    encode_snapshot,
+    etag_matches,
+    parse_range,
+)
+from tenants import (
+    TenantMiddleware,
+    TenantRegistry,
+    collection_name,
+    current_tenant,
+    tenant_scope,
+    valid_tenant_name,
+)
+
 try:
     from keys import PROJECT_KEY
 except:
     # When running on CI services.
     PROJECT_KEY = os.getenv("DETA_PROJECT_KEY", default="PROJECT_KEY")
 
+if TYPE_CHECKING:
+    from deta import Deta
+    from deta.base import Base
+    from passlib.context import CryptContext
+
 
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")
 HASHED_PASSWORD = "$2b$12$VOGTaA8tXdYoAU4Js6NBXO9uL..rXITV.WMiF/g8MEmCtdoMjLkOK"
-pwd_context = CryptContext(schemes=["bcrypt"])
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", default="1") != "0"
 
 app = FastAPI()
+app.router.route_class = ProfiledRoute
 
 EPOCH = datetime.utcfromtimestamp(0)
 
 #### ---- Datebases ---- ####
 
-deta = Deta(PROJECT_KEY)  # no key needed with using Deta Micro
+# The Deta client and the bases are only created when they are first used to
+# keep cold starts short.
+
+
+@lru_cache(maxsize=None)
+def get_deta() -> "Deta":
+    from deta import Deta
+
+    return Deta(PROJECT_KEY)  # no key needed with using Deta Micro
+
+
+def deta_base(name: str) -> "Base":
+    return get_deta().Base(name)
+
+
+# Calls to Deta get timeouts, retries and hedging for reads, and a circuit
+# breaker (see `backend.py`) unless `RESILIENT_BACKEND=0`.
+
+RESILIENT_BACKEND = os.getenv("RESILIENT_BACKEND", default="1") != "0"
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", default="5"))
+BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", default="2"))
+
+backend_policy = CallPolicy(timeout=BACKEND_TIMEOUT, retries=BACKEND_RETRIES)
+
+
+def resilient_deta_base(name: str) -> ResilientBase:
+    return ResilientBase(
+        deta_base(name), name=name, policy=backend_policy, breaker=CircuitBreaker()
+    )
+
+
+base_factory: Callable[[str], Any] = (
+    resilient_deta_base if RESILIENT_BACKEND else deta_base
+)
+
+
+class LazyBase:
+    # A partitioned base resolves to the current tenant's own collection (see
+    # `tenants.py`); the handle of each tenant's collection is cached.
+    def __init__(self, name: str, partitioned: bool = True) -> None:
+        self.name = name
+        self.partitioned = partitioned
+        self._bases: Dict[Optional[str], Any] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self) -> Any:
+        tenant = current_tenant() if self.partitioned else None
+        base = self._bases.get(tenant)
+        if base is None:
+            with self._lock:
+                base = self._bases.get(tenant)
+                if base is None:
+                    base = base_factory(collection_name(self.name, tenant))
+                    self._bases[tenant] = base
+        return base
+
+    def reset(self) -> None:
+        self._bases = {}
+
+    def handles(self) -> Dict[Optional[str], Any]:
+        return dict(self._bases)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.resolve(), attr)
+
+
+# coffee_bag_db = LazyBase("coffee_bag_db-TEST")
+# coffee_use_db = LazyBase("coffee_use_db-TEST")
+# meta_db = LazyBase("meta_db-TEST")
+
+coffee_bag_db = LazyBase("coffee_bag_db")
+coffee_use_db = LazyBase("coffee_use_db")
+meta_db = LazyBase("meta_db")
+change_db = LazyBase("change_db")
+tenant_db = LazyBase("tenant_db", partitioned=False)
+
+tenant_registry = TenantRegistry(tenant_db)
+
+
+def archive_drive(name: str) -> Any:
+    if ARCHIVE_DIR is not None:
+        return LocalDrive(os.path.join(ARCHIVE_DIR, name))
+    return get_deta().Drive(name)
+
+
+drive_factory: Callable[[str], Any] = archive_drive
+
+
+@lru_cache(maxsize=None)
+def tenant_archive(tenant: Optional[str]) -> SegmentArchive:
+    return SegmentArchive(drive_factory(collection_name("coffee_use_archive", tenant)))
+
+
+def get_archive() -> SegmentArchive:
+    return tenant_archive(current_tenant())
+
+
+def use_drive_factory(factory: Callable[[str], Any]) -> None:
+    global drive_factory
+    drive_factory = factory
+    tenant_archive.cache_clear()
+    clear_snapshots()
+
+
+def use_base_factory(factory: Callable[[str], Any]) -> None:
+    # Swap the backing store of every base (e.g. for an in-memory stand-in).
+    global base_factory
+    base_factory = factory
+    for db in (coffee_bag_db, coffee_use_db, meta_db, change_db, tenant_db):
+        db.reset()
+    tenant_registry.clear_cache()
+    cache.clear()
+    clear_snapshots()
+    clear_bag_indexes()
+
+
+#### ---- Cache ---- ####
+
+# Bags, counters and recent uses are cached for `CACHE_TTL` seconds (0 turns the
+# cache off), and a tenant's entries are invalidated whenever a write commits.
+# Workers on the same host share the cache through the unix socket at
+# `CACHE_SOCKET` if it is set (see `shared_cache.py`). Without it, a worker would
+# not see the invalidations of the others, so the cache is off by default.
+# Deletes and maintenance always read the bases themselves.
+
+CACHE_SOCKET = os.getenv("CACHE_SOCKET")
+CACHE_TTL = float(os.getenv("CACHE_TTL", default="0" if CACHE_SOCKET is None else "30"))
 
-# coffee_bag_db = deta.Base("coffee_bag_db-TEST")
-# coffee_use_db = deta.Base("coffee_use_db-TEST")
-# meta_db = deta.Base("meta_db-TEST")
+cache: Union[LocalCache, SharedCache] = (
+    LocalCache() if CACHE_SOCKET is None else SharedCache(CACHE_SOCKET)
+)
 
-coffee_bag_db = deta.Base("coffee_bag_db")
-coffee_use_db = deta.Base("coffee_use_db")
-meta_db = deta.Base("meta_db")
+CachedType = TypeVar("CachedType")
+
+
+def cache_namespace() -> str:
+    tenant = current_tenant()
+    return "" if tenant is None else tenant
+
+
+def cached(key: str, build: Callable[[], CachedType]) -> CachedType:
+    # The value must survive a round trip through JSON unchanged.
+    if CACHE_TTL <= 0:
+        return build()
+    namespace = cache_namespace()
+    with phase("cache"):
+        value, generation = cache.get(namespace, key)
+    if value is not None:
+        return json.loads(value)
+    result = build()
+    with phase("cache"):
+        encoded = json.dumps(result).encode()
+        cache.set(namespace, key, encoded, ttl=CACHE_TTL, generation=generation)
+    return result
+
+
+def invalidate_cache() -> None:
+    if CACHE_TTL > 0:
+        cache.invalidate(cache_namespace())
 
 
 #### ---- Dates and Times ---- ####
@@ -80,14 +302,29 @@ class CoffeeBag(KeyedModel):
             self._key = key
 
 
+class BagUpdate(BaseModel):
+    # A partial update of a bag: only the fields that are set are changed.
+    brand: Optional[str]
+    name: Optional[str]
+    weight: Optional[float]
+    start: Optional[date]
+    finish: Optional[date]
+    active: Optional[bool]
+
+    class Config:
+        extra = "forbid"
+
+
 class CoffeeUse(KeyedModel):
     bag_id: str
     datetime: datetime
     _seconds: float = PrivateAttr(0)
+    _day: str = PrivateAttr("")
 
     def __init__(self, **data):
         super().__init__(**data)
         self._seconds = unix_time_millis(self.datetime)
+        self._day = self.datetime.date().isoformat()
         key = data.get("key")
         if key is not None:
             self._key = key
@@ -116,6 +353,7 @@ def convert_info_to_use(info: Dict[str, Any]) -> CoffeeUse:
 def convert_use_to_info(use: CoffeeUse) -> Dict[str, Any]:
     info = jsonable_encoder(use)
     info["_seconds"] = use._seconds
+    info["_day"] = use._day
     info["key"] = use._key
     return info
 
@@ -124,24 +362,40 @@ def keyedlist_to_dict(x: List[KeyedObjectType]) -> Dict[str, KeyedObjectType]:
     return {y._key: y for y in x}
 
 
-def get_all_detabase_info(db: Base, n_items: int):
-    n_buffer = 100
-    n_pages = ceil(n_items / n_buffer) + 1  # add one just in case
+# A query, or a list of queries any of which an item may match.
+DetaQuery = Union[Dict[str, Any], List[Dict[str, Any]]]
 
-    pages = db.fetch(query=None, buffer=n_buffer, pages=n_pages)
-    info: List[Dict[str, Any]] = []
-    for page in pages:
-        info += page
-    return info
+
+def resolve_base(db: Any) -> Any:
+    # Worker threads do not see the request's tenant, so a base that is used
+    # from other threads is resolved beforehand.
+    return db.resolve() if isinstance(db, LazyBase) else db
+
+
+def fetch_pages(
+    db: Any, query: Optional[DetaQuery] = None, buffer: int = DEFAULT_BUFFER
+) -> Iterator[Page]:
+    return iter_pages(resolve_base(db), query=query, buffer=buffer)
+
+
+def fetch_records(
+    db: Any, query: Optional[DetaQuery] = None, buffer: int = DEFAULT_BUFFER
+) -> Iterator[Dict[str, Any]]:
+    return iter_records(resolve_base(db), query=query, buffer=buffer)
+
+
+def get_all_detabase_info(db: "Base") -> List[Dict[str, Any]]:
+    return list(fetch_records(db))
 
 
 def get_all_coffee_bag_info() -> List[Dict[str, Any]]:
-    num_bags = num_coffee_bags()
-    return get_all_detabase_info(coffee_bag_db, n_items=num_bags)
+    return cached("bags", lambda: get_all_detabase_info(coffee_bag_db))
 
 
 def coffee_bag_list() -> List[CoffeeBag]:
-    return [convert_info_to_bag(info) for info in get_all_coffee_bag_info()]
+    info = get_all_coffee_bag_info()
+    with phase("convert"):
+        return [convert_info_to_bag(i) for i in info]
 
 
 def coffee_bag_dict() -> Dict[str, CoffeeBag]:
@@ -149,15 +403,36 @@ def coffee_bag_dict() -> Dict[str, CoffeeBag]:
 
 
 def get_all_coffee_use_info() -> List[Dict[str, Any]]:
-    num_uses = num_coffee_uses()
-    return get_all_detabase_info(coffee_use_db, n_items=num_uses)
+    return get_all_detabase_info(coffee_use_db)
 
 
 def coffee_use_dict() -> Dict[str, CoffeeUse]:
-    uses = [convert_info_to_use(info) for info in get_all_coffee_use_info()]
+    uses: List[CoffeeUse] = []
+    for page in fetch_pages(coffee_use_db):
+        with phase("convert"):
+            uses += [convert_info_to_use(i) for i in page]
     return keyedlist_to_dict(uses)
 
 
+def coffee_use_keys(
+    query: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+) -> List[str]:
+    return [info["key"] for info in fetch_records(coffee_use_db, query=query)]
+
+
+N_PARALLEL_DELETES = 8
+
+
+def delete_keys(db: "Base", keys: List[str]) -> None:
+    # Deta Base has no batch delete, so the deletes are issued in parallel.
+    if len(keys) == 0:
+        return None
+    base = resolve_base(db)
+    with phase("deta_delete"), ThreadPoolExecutor(N_PARALLEL_DELETES) as executor:
+        list(executor.map(base.delete, keys))
+    return None
+
+
 def sort_coffee_bags(bags: List[CoffeeBag]):
     def f(b: CoffeeBag) -> date:
         if b.start is None:
@@ -177,20 +452,44 @@ META_DB_KEY = "KEY"
 class MetaDataField(str, Enum):
     bag_count = "bag_count"
     use_count = "use_count"
+    archive_horizon = "archive_horizon"
+    archive_generation = "archive_generation"
+    day_index = "day_index"
+    first_use = "first_use"
 
 
-def initialize_meta_db(bag_count: int = 0, use_count: int = 0):
+def initialize_meta_db(bag_count: int = 0, use_count: int = 0, day_index: bool = False):
+    # The day index may only be used once every use has its day bucket, i.e.
+    # for a new database or after `add_day_attribute_to_coffee_uses()`.
     meta_db.put(
-        {MetaDataField.bag_count: bag_count, MetaDataField.use_count: use_count},
+        {
+            MetaDataField.bag_count: bag_count,
+            MetaDataField.use_count: use_count,
+            MetaDataField.day_index: day_index,
+        },
         key=META_DB_KEY,
     )
+    invalidate_cache()
 
 
-def increment_meta_count(field: MetaDataField, by: int):
+def update_meta_db(updates: Dict[str, Any]) -> None:
+    # The meta record is only created if it does not exist; any other failure
+    # (e.g. of the backend) is raised so that the counters are not reset.
     try:
-        meta_db.update({field: meta_db.util.increment(by)}, key=META_DB_KEY)
-    except:
-        initialize_meta_db(**{field.value: by})
+        meta_db.update(updates, key=META_DB_KEY)
+    except BackendError:
+        raise
+    except Exception:
+        if meta_db.get(key=META_DB_KEY) is not None:
+            raise
+        # A new database: all of its uses will have a day bucket.
+        initialize_meta_db(day_index=True)
+        meta_db.update(updates, key=META_DB_KEY)
+
+
+def increment_meta_count(field: MetaDataField, by: int):
+    update_meta_db({field: meta_db.util.increment(by)})
+    invalidate_cache()
     return None
 
 
@@ -204,31 +503,294 @@ def increment_coffee_use(by: int = 1):
 
 def reset_coffee_bag_count():
     meta_db.update({MetaDataField.bag_count: 0}, key=META_DB_KEY)
+    invalidate_cache()
 
 
 def reset_coffee_use_count():
     meta_db.update({MetaDataField.use_count: 0}, key=META_DB_KEY)
+    invalidate_cache()
 
 
-def num_coffee_bags() -> int:
-    res: Optional[Dict[str, Any]] = meta_db.get(key=META_DB_KEY)
+def read_meta_info() -> Dict[str, Any]:
+    with phase("deta_get"):
+        res: Optional[Dict[str, Any]] = meta_db.get(key=META_DB_KEY)
     if res is None:
-        return 0
-    return res[MetaDataField.bag_count]
+        return {MetaDataField.bag_count: 0, MetaDataField.use_count: 0}
+    return res
+
+
+def get_meta_info() -> Dict[str, Any]:
+    return cached("meta", read_meta_info)
+
+
+def num_coffee_bags() -> int:
+    return get_meta_info()[MetaDataField.bag_count]
 
 
 def num_coffee_uses() -> int:
-    res: Optional[Dict[str, Any]] = meta_db.get(key=META_DB_KEY)
-    if res is None:
-        return 0
-    return res[MetaDataField.use_count]
+    return get_meta_info()[MetaDataField.use_count]
+
+
+#### ---- Archive ---- ####
+
+# Uses older than the archive horizon (ms since the epoch, stored in the meta
+# record) live in compressed segments instead of the hot base.
+
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", default="90"))
+
+
+def get_archive_horizon(meta: Optional[Dict[str, Any]] = None) -> Optional[float]:
+    if meta is None:
+        meta = get_meta_info()
+    return meta.get(MetaDataField.archive_horizon)
+
+
+def get_archive_generation(meta: Dict[str, Any]) -> int:
+    # Bumped with every change to the archive's segments.
+    return meta.get(MetaDataField.archive_generation, 0)
+
+
+def bump_archive_generation() -> None:
+    increment_meta_count(MetaDataField.archive_generation, by=1)
+
+
+def reaches_archive(since: Optional[datetime], horizon: Optional[float]) -> bool:
+    if horizon is None:
+        return False
+    return since is None or unix_time_millis(since) < horizon
+
+
+def archived_coffee_use_info(
+    since: Optional[datetime] = None,
+    bag_id: Optional[str] = None,
+    limit: Optional[int] = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    if meta is None:
+        meta = get_meta_info()
+    since_ms = None if since is None else unix_time_millis(since)
+    with phase("archive_read"):
+        return list(
+            get_archive().read(
+                since_ms=since_ms,
+                bag_id=bag_id,
+                limit=limit,
+                horizon=get_archive_horizon(meta),
+                generation=get_archive_generation(meta),
+            )
+        )
+
+
+def set_archive_horizon(horizon: Optional[float]):
+    # The segments have changed as well.
+    value = meta_db.util.trim() if horizon is None else horizon
+    update_meta_db(
+        {
+            MetaDataField.archive_horizon: value,
+            MetaDataField.archive_generation: meta_db.util.increment(1),
+        }
+    )
+    invalidate_cache()
+
+
+def archive_coffee_uses(horizon_days: int = ARCHIVE_HORIZON_DAYS) -> int:
+    horizon = unix_time_millis(today_at_midnight() - timedelta(days=horizon_days))
+    current_horizon = get_archive_horizon(read_meta_info())
+    if current_horizon is not None and current_horizon > horizon:
+        # The horizon never moves back.
+        horizon = current_horizon
+
+    infos = list(fetch_records(coffee_use_db, query={"_seconds?lt": horizon}))
+
+    if len(infos) > 0:
+        get_archive().write(infos)
+    # The horizon is moved before the uses are removed from the hot base so
+    # that queries never miss them (duplicates are dropped when merging).
+    set_archive_horizon(horizon)
+    delete_keys(coffee_use_db, [info["key"] for info in infos])
+    return len(infos)
+
+
+#### ---- Change events ---- ####
+
+# Every change is recorded in the change log (see `changes.py`) and published
+# to the subscribers of the change events.
+
+CHANGE_LOG_DELAY = float(os.getenv("CHANGE_LOG_DELAY", default="15"))
+
+broadcaster = Broadcaster()
+change_log = ChangeLog(change_db, delay=CHANGE_LOG_DELAY)
+
+
+def publish_changes(
+    collection: Collection,
+    op: ChangeOp,
+    items: List[Tuple[str, Optional[Dict[str, Any]]]],
+) -> None:
+    if len(items) == 0:
+        return None
+    # Published once the data and the counters are written: a change that
+    # cannot be recorded yet is recorded later instead of failing the request.
+    invalidate_cache()
+    change_log.record(collection, op, items)
+    tenant = current_tenant()
+    for key, data in items:
+        broadcaster.publish(collection, op, key=key, data=data, tenant=tenant)
+
+
+def publish_change(
+    collection: Collection,
+    op: ChangeOp,
+    key: str,
+    data: Optional[Dict[str, Any]] = None,
+) -> None:
+    publish_changes(collection, op, [(key, data)])
+
+
+def publish_deletes(collection: Collection, keys: List[str]) -> None:
+    publish_changes(collection, ChangeOp.delete, [(key, None) for key in keys])
+
+
+def publish_bag_change(op: ChangeOp, bag: CoffeeBag) -> None:
+    publish_change(Collection.bags, op, key=bag._key, data=convert_bag_to_info(bag))
+
+
+#### ---- Snapshot ---- ####
+
+# A compressed, columnar snapshot of each tenant's bags and uses is built when it
+# is first requested. From then on it is rebuilt in the background after writes
+# (debounced by `SNAPSHOT_DELAY` seconds) and at least every `SNAPSHOT_MAX_AGE`
+# seconds to pick up changes made by other instances.
+
+SNAPSHOT_DELAY = float(os.getenv("SNAPSHOT_DELAY", default="5"))
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", default="3600"))
+
+
+def all_coffee_use_info() -> List[Dict[str, Any]]:
+    info = get_all_detabase_info(coffee_use_db)
+    meta = get_meta_info()
+    if get_archive_horizon(meta) is not None:
+        info += archived_coffee_use_info(meta=meta)
+        info = list({i["key"]: i for i in info}.values())
+    return info
+
+
+def build_snapshot() -> Snapshot:
+    created = datetime.now()
+    bags = get_all_coffee_bag_info()
+    uses = all_coffee_use_info()
+    return Snapshot(encode_snapshot(bags, uses, created=created), created=created)
+
+
+def build_tenant_snapshot(tenant: Optional[str]) -> Snapshot:
+    # Rebuilds run in a timer thread, outside of the request's context.
+    with tenant_scope(tenant):
+        return build_snapshot()
+
+
+_snapshots: Dict[Optional[str], SnapshotMaterializer] = {}
+_snapshots_lock = threading.Lock()
+
+
+def tenant_snapshots(tenant: Optional[str]) -> SnapshotMaterializer:
+    with _snapshots_lock:
+        materializer = _snapshots.get(tenant)
+        if materializer is None:
+            materializer = SnapshotMaterializer(
+                lambda: build_tenant_snapshot(tenant),
+                delay=SNAPSHOT_DELAY,
+                max_age=SNAPSHOT_MAX_AGE,
+            )
+            _snapshots[tenant] = materializer
+    return materializer
+
+
+def clear_snapshots() -> None:
+    with _snapshots_lock:
+        for materializer in _snapshots.values():
+            materializer.clear()
+        _snapshots.clear()
+
+
+def mark_snapshot_dirty(event: ChangeEvent) -> None:
+    with _snapshots_lock:
+        materializer = _snapshots.get(event.tenant)
+    if materializer is not None and materializer.requested:
+        materializer.mark_dirty()
+
+
+broadcaster.add_listener(mark_snapshot_dirty)
+
+
+#### ---- Bag search ---- ####
+
+# Each tenant's bags are searched in an in-memory index (see `search.py`) that
+# is loaded on the first search, kept up to date by the change events, and
+# reloaded every `SEARCH_INDEX_MAX_AGE` seconds to pick up changes made by
+# other instances.
+
+SEARCH_INDEX_MAX_AGE = float(os.getenv("SEARCH_INDEX_MAX_AGE", default="300"))
+
+_bag_indexes: Dict[Optional[str], BagIndex] = {}
+_bag_indexes_lock = threading.Lock()
+
+
+def tenant_bag_index(tenant: Optional[str]) -> BagIndex:
+    with _bag_indexes_lock:
+        index = _bag_indexes.get(tenant)
+        if index is None:
+            index = _bag_indexes[tenant] = BagIndex()
+    return index
+
+
+def bag_search_index() -> BagIndex:
+    index = tenant_bag_index(current_tenant())
+    age = index.age
+    if age is None or age > SEARCH_INDEX_MAX_AGE:
+        version = index.version
+        index.load(get_all_coffee_bag_info(), version=version)
+    return index
+
+
+def clear_bag_indexes() -> None:
+    with _bag_indexes_lock:
+        _bag_indexes.clear()
+
+
+def index_bag_change(event: ChangeEvent) -> None:
+    if event.collection != Collection.bags:
+        return None
+    index = tenant_bag_index(event.tenant)
+    if event.op == ChangeOp.delete:
+        index.remove(event.key)
+    elif event.data is not None:
+        index.add(event.key, event.data)
+
+
+broadcaster.add_listener(index_bag_change)
 
 
 #### ---- Security ---- ####
 
 
+@lru_cache(maxsize=None)
+def get_pwd_context() -> "CryptContext":
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"])
+
+
+def hashed_password() -> Optional[str]:
+    tenant = current_tenant()
+    if tenant is None:
+        return HASHED_PASSWORD
+    info = tenant_registry.get(tenant)
+    return None if info is None else info["hashed_password"]
+
+
 def compare_password(password: str) -> bool:
-    return pwd_context.verify(password, HASHED_PASSWORD)
+    hashed = hashed_password()
+    return hashed is not None and get_pwd_context().verify(password, hashed)
 
 
 def verify_password(password: str) -> bool:
@@ -239,6 +801,58 @@ def verify_password(password: str) -> bool:
     return True
 
 
+def verify_admin_password(password: str) -> bool:
+    # Deployment-wide endpoints are only available without a tenant.
+    if current_tenant() is not None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only available to the administrator.",
+        )
+    return verify_password(password)
+
+
+#### ---- Warm-up ---- ####
+
+
+def warm_up() -> None:
+    # Load the bcrypt backend and open the connections to the bases by
+    # prefetching the active bags and counters.
+    get_pwd_context().handler("bcrypt").get_backend()
+    try:
+        get_active_bags(n_last=None)
+        num_coffee_bags()
+        num_coffee_uses()
+    except Exception as err:
+        print(f"Warm-up failed: {err}")
+
+
+@app.on_event("startup")
+def start_warm_up() -> None:
+    if WARM_UP_ON_STARTUP:
+        threading.Thread(target=warm_up, daemon=True).start()
+
+
+#### ---- Profiling ---- ####
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", default="0"))
+
+app.add_middleware(
+    ProfilingMiddleware, authorize=compare_password, sample_rate=PROFILE_SAMPLE_RATE
+)
+
+
+#### ---- Tenants ---- ####
+
+
+def tenant_exists(tenant: str) -> bool:
+    return tenant_registry.get(tenant) is not None
+
+
+# Added after the profiler so that it runs first and the tenant is known to the
+# profiler.
+app.add_middleware(TenantMiddleware, exists=tenant_exists)
+
+
 #### ---- Error messages ---- ####
 
 
@@ -249,20 +863,115 @@ def raise_bag_not_found(bag_id: str) -> None:
 
 
 def raise_server_error(err: Exception) -> None:
+    if isinstance(err, BackendError):
+        raise err
     raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(err))
 
 
+@app.exception_handler(BackendError)
+async def backend_error_handler(request: Request, err: BackendError) -> JSONResponse:
+    if isinstance(err, BackendUnavailable):
+        return JSONResponse(
+            {"detail": str(err)},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": "30"},
+        )
+    if isinstance(err, BackendTimeout):
+        return JSONResponse(
+            {"detail": str(err)}, status_code=status.HTTP_504_GATEWAY_TIMEOUT
+        )
+    return JSONResponse(
+        {"detail": str(err)}, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+    )
+
+
 def raise_invalid_field(field: str):
     raise HTTPException(
         status.HTTP_404_NOT_FOUND, detail=f"Field '{field}' is not a valid field."
     )
 
 
+def raise_profile_not_found(id: str) -> NoReturn:
+    raise HTTPException(
+        status.HTTP_404_NOT_FOUND, detail=f"Profile with id '{id}' not found."
+    )
+
+
+def raise_tenant_not_found(name: str) -> None:
+    raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Tenant '{name}' not found.")
+
+
+def raise_invalid_tenant_name(name: str) -> None:
+    raise HTTPException(
+        status.HTTP_400_BAD_REQUEST,
+        detail=f"Invalid tenant name '{name}': use up to 32 lowercase letters, "
+        + "digits, '-' and '_'.",
+    )
+
+
 #### ---- Response Models ---- ####
 
 BagResponse = Dict[str, CoffeeBag]
 UseResponse = Dict[str, CoffeeUse]
 
+
+class BagUpdateResult(BaseModel):
+    updated: bool
+    bag: Optional[CoffeeBag] = None
+    error: Optional[str] = None
+
+
+BatchUpdateResponse = Dict[str, BagUpdateResult]
+
+
+class DashboardResponse(BaseModel):
+    active_bags: BagResponse
+    recent_uses: UseResponse
+    number_of_bags: int
+    number_of_uses: int
+    active_bag_uses: Dict[str, int]
+
+
+#### ---- Response formats ---- ####
+
+# The listings can also be sent as columns (see `formats.py`) and responses are
+# compressed for clients that accept gzip.
+
+LISTING_RESPONSES: Dict[Union[int, str], Dict[str, Any]] = {
+    200: {"content": {COLUMNAR_JSON: {}, MSGPACK: {}}}
+}
+
+app.add_middleware(
+    CompressionMiddleware, minimum_size=1000, exclude_paths=["/events/", "/snapshot/"]
+)
+
+
+def raise_not_acceptable() -> NoReturn:
+    raise HTTPException(
+        status.HTTP_406_NOT_ACCEPTABLE,
+        detail=f"Available formats: {', '.join(available_formats())}.",
+        headers={"Vary": "Accept"},
+    )
+
+
+def format_listing(
+    request: Request,
+    response: Response,
+    listing: Dict[str, Any],
+    to_columns: ColumnsFunction,
+) -> Any:
+    # The body depends on the `Accept` header, so caches have to key on it.
+    media_type = negotiate(request.headers.get("accept"))
+    if media_type is None:
+        raise_not_acceptable()
+    if media_type == JSON:
+        response.headers["Vary"] = "Accept"
+        return listing
+    with phase("encode"):
+        body = encode_columns(to_columns(listing.values()), media_type)
+    return Response(body, media_type=media_type, headers={"Vary": "Accept"})
+
+
 #### ---- Start Page ---- ####
 
 
@@ -274,9 +983,21 @@ async def root():
 #### ---- Getters ---- ####
 
 
-@app.get("/bags/", response_model=BagResponse)
-def get_bags() -> BagResponse:
-    return coffee_bag_dict()
+@app.get("/bags/", response_model=BagResponse, responses=LISTING_RESPONSES)
+def get_bags(request: Request, response: Response) -> BagResponse:
+    return format_listing(request, response, coffee_bag_dict(), bag_columns)
+
+
+@app.get("/bags/search/", response_model=BagResponse)
+def search_bags(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    fuzzy: bool = False,
+) -> BagResponse:
+    # Bags whose brand and name match `q`, best matches first.
+    infos = bag_search_index().search(q, limit=limit, fuzzy=fuzzy)
+    with phase("convert"):
+        return keyedlist_to_dict([convert_info_to_bag(info) for info in infos])
 
 
 @app.get("/number_of_bags/", response_model=int)
@@ -293,20 +1014,17 @@ def get_bag_info(bag_id: str) -> BagResponse:
     return {bag._key: bag}
 
 
-@app.get("/active_bags/", response_model=BagResponse)
-def get_active_bags(n_last: Optional[int] = Query(None, ge=1)) -> BagResponse:
+def active_coffee_bag_info() -> List[Dict[str, Any]]:
+    return list(fetch_records(coffee_bag_db, query={"active": True}))
 
-    n_bags = num_coffee_bags()
-    n_buffer = 100
-    n_pages = ceil(n_bags / n_buffer) + 1
-    bags: List[CoffeeBag] = []
 
-    for page in coffee_bag_db.fetch(
-        query={"active": True}, buffer=n_buffer, pages=n_pages
-    ):
-        bags = [convert_info_to_bag(i) for i in page]
+def active_coffee_bags(n_last: Optional[int] = None) -> BagResponse:
+    info = cached("bags:active", active_coffee_bag_info)
+    with phase("convert"):
+        bags = [convert_info_to_bag(i) for i in info]
 
-    sort_coffee_bags(bags)
+    with phase("sort"):
+        sort_coffee_bags(bags)
 
     if n_last is not None:
         bags = bags[-n_last:]
@@ -314,18 +1032,14 @@ def get_active_bags(n_last: Optional[int] = Query(None, ge=1)) -> BagResponse:
     return keyedlist_to_dict(bags)
 
 
-def query_coffee_uses_db(
-    n_last: Optional[int] = None,
-    since: Optional[datetime] = None,
-    bag_id: Optional[str] = None,
-) -> UseResponse:
-    if n_last is None:
-        n_last = num_coffee_uses()
+@app.get("/active_bags/", response_model=BagResponse)
+def get_active_bags(n_last: Optional[int] = Query(None, ge=1)) -> BagResponse:
+    return active_coffee_bags(n_last=n_last)
 
-    buffer_size = 300
-    pages = ceil(n_last / buffer_size)
-    uses: List[CoffeeUse] = []
 
+def coffee_use_query(
+    since: Optional[datetime] = None, bag_id: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
     query_prep: Dict[str, Any] = {}
     if bag_id is not None:
         query_prep["bag_id"] = bag_id
@@ -335,29 +1049,217 @@ def query_coffee_uses_db(
     query: Optional[Dict[str, Any]] = None
     if len(query_prep.keys()) > 0:
         query = query_prep
+    return query
+
+
+# A `since` window of up to `DAY_INDEX_MAX_DAYS` days is fetched with one
+# equality query per day bucket (`_day`), run in parallel, instead of a scan
+# over all uses.
+
+DAY_INDEX_MAX_DAYS = 31
+N_PARALLEL_QUERIES = 8
+
+
+def day_buckets(since: Optional[datetime], meta: Dict[str, Any]) -> Optional[List[str]]:
+    if since is None or not meta.get(MetaDataField.day_index, False):
+        return None
+    first = since.date()
+    # Include tomorrow in case the client's clock is ahead of the server's.
+    n_days = (date.today() + timedelta(days=1) - first).days + 1
+    if n_days <= 0 or n_days > DAY_INDEX_MAX_DAYS:
+        return None
+    return [(first + timedelta(days=i)).isoformat() for i in range(n_days)]
+
+
+def fetch_day_buckets(
+    days: List[str], query: Optional[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    # Resolved for the request's tenant before the worker threads use it.
+    use_db = resolve_base(coffee_use_db)
+
+    def fetch(q: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return list(iter_records(use_db, query=q))
+
+    queries = [dict(query or {}, _day=day) for day in days]
+    with phase("deta_fetch"), ThreadPoolExecutor(N_PARALLEL_QUERIES) as executor:
+        return [info for res in executor.map(fetch, queries) for info in res]
+
+
+def fetch_coffee_use_info(
+    since: Optional[datetime], bag_id: Optional[str], meta: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    query = coffee_use_query(since=since, bag_id=bag_id)
+    days = day_buckets(since, meta)
+    if days is None:
+        return list(fetch_records(coffee_use_db, query=query))
+    return fetch_day_buckets(days, query)
+
+
+# Without a `since` window, the newest uses are first looked for in growing
+# windows of recent days (using the day buckets) and only if there are not
+# enough of them are all uses read. A window is skipped if, going by the number
+# of uses since the first one, it is not expected to hold `n_last` uses.
+
+RECENT_WINDOWS_DAYS = (7, DAY_INDEX_MAX_DAYS - 2)
+MS_PER_DAY = 24 * 60 * 60 * 1000.0
+
+
+def expected_coffee_uses(n_days: int, meta: Dict[str, Any]) -> Optional[float]:
+    first_use = meta.get(MetaDataField.first_use)
+    if first_use is None:
+        return None
+    age_days = max((unix_time_millis(datetime.now()) - first_use) / MS_PER_DAY, 1.0)
+    return meta[MetaDataField.use_count] * min(n_days / age_days, 1.0)
+
+
+def record_first_use(info: List[Dict[str, Any]], meta: Dict[str, Any]) -> None:
+    # All uses were read, so the time of the first one is known. Older uses in
+    # the archive only make the estimates of the windows more cautious.
+    if len(info) == 0 or MetaDataField.first_use in meta:
+        return None
+    if meta.get(MetaDataField.use_count, 0) == 0:
+        # There is no meta record yet.
+        return None
+    first_use = min(i["_seconds"] for i in info)
+    update_meta_db({MetaDataField.first_use: first_use})
+    invalidate_cache()
+
+
+def recent_coffee_use_info(
+    n_last: int, bag_id: Optional[str], meta: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    if meta.get(MetaDataField.day_index, False) and n_last <= meta.get(
+        MetaDataField.use_count, 0
+    ):
+        info: List[Dict[str, Any]] = []
+        fetched: Set[str] = set()
+        for n_days in RECENT_WINDOWS_DAYS:
+            expected = expected_coffee_uses(n_days, meta)
+            if expected is not None and expected < n_last:
+                continue
+            since = today_at_midnight() - timedelta(days=n_days)
+            days = day_buckets(since, meta)
+            if days is None:
+                break
+            # Only the days that the smaller window did not cover are fetched.
+            query = coffee_use_query(since=since, bag_id=bag_id)
+            info += fetch_day_buckets([d for d in days if d not in fetched], query)
+            fetched.update(days)
+            if len(info) >= n_last:
+                return info
+
+    info = fetch_coffee_use_info(since=None, bag_id=bag_id, meta=meta)
+    if bag_id is None:
+        record_first_use(info, meta)
+    return info
+
+
+def count_coffee_uses(
+    since: Optional[datetime] = None,
+    bag_id: Optional[str] = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> int:
+    if since is None:
+        return cached(
+            f"uses:count:{bag_id}", lambda: _count_coffee_uses(None, bag_id, meta)
+        )
+    return _count_coffee_uses(since, bag_id, meta)
+
+
+def _count_coffee_uses(
+    since: Optional[datetime], bag_id: Optional[str], meta: Optional[Dict[str, Any]]
+) -> int:
+    if meta is None:
+        meta = get_meta_info()
+
+    info = fetch_coffee_use_info(since=since, bag_id=bag_id, meta=meta)
+    keys = [i["key"] for i in info]
+
+    horizon = get_archive_horizon(meta)
+    if not reaches_archive(since, horizon):
+        return len(keys)
+
+    archived = archived_coffee_use_info(since=since, bag_id=bag_id, meta=meta)
+    return len(set(keys).union(info["key"] for info in archived))
+
+
+def count_coffee_uses_by_bag(
+    bag_ids: List[str], meta: Dict[str, Any]
+) -> Dict[str, int]:
+    # The uses of all of the bags are read in one pass (and one of the archive)
+    # instead of a filtered scan per bag.
+    counts = {id: 0 for id in bag_ids}
+    bags: Dict[str, str] = {}
+    if len(bag_ids) > 0:
+        query = [{"bag_id": id} for id in bag_ids]
+        bags = {i["key"]: i["bag_id"] for i in fetch_records(coffee_use_db, query)}
+        if get_archive_horizon(meta) is not None:
+            for info in archived_coffee_use_info(meta=meta):
+                if info["bag_id"] in counts:
+                    bags[info["key"]] = info["bag_id"]
+    for bag_id in bags.values():
+        counts[bag_id] += 1
+    return counts
+
+
+def coffee_use_info(
+    n_last: int,
+    since: Optional[datetime],
+    bag_id: Optional[str],
+    meta: Dict[str, Any],
+) -> List[Dict[str, Any]]:
+    if since is None:
+        info = recent_coffee_use_info(n_last, bag_id=bag_id, meta=meta)
+    else:
+        info = fetch_coffee_use_info(since=since, bag_id=bag_id, meta=meta)
 
-    print(query)
-    if since:
-        print(unix_time_millis(since) < unix_time_millis())
+    # Only read the archive if the window reaches into archived time.
+    if since is not None or len(info) < n_last:
+        horizon = get_archive_horizon(meta)
+        if reaches_archive(since, horizon):
+            info += archived_coffee_use_info(
+                since=since, bag_id=bag_id, limit=n_last, meta=meta
+            )
+            info = list({i["key"]: i for i in info}.values())
 
-    for page in coffee_use_db.fetch(query=query, buffer=300, pages=pages):
-        uses += [convert_info_to_use(i) for i in page]
+    with phase("sort"):
+        info.sort(key=lambda x: x["_seconds"])
+    return info[-n_last:] if len(info) > n_last else info
 
-    uses.sort(key=lambda x: x.datetime)
 
-    if len(uses) > n_last:
-        uses = uses[-n_last:]
+def query_coffee_uses_db(
+    n_last: Optional[int] = None,
+    since: Optional[datetime] = None,
+    bag_id: Optional[str] = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> UseResponse:
+    if meta is None:
+        meta = get_meta_info()
+    n = meta[MetaDataField.use_count] if n_last is None else n_last
+
+    if since is None:
+        info = cached(
+            f"uses:recent:{n}:{bag_id}",
+            lambda: coffee_use_info(n, since=None, bag_id=bag_id, meta=meta),
+        )
+    else:
+        info = coffee_use_info(n, since=since, bag_id=bag_id, meta=meta)
 
+    with phase("convert"):
+        uses = [convert_info_to_use(i) for i in info]
     return keyedlist_to_dict(uses)
 
 
-@app.get("/uses/", response_model=UseResponse)
+@app.get("/uses/", response_model=UseResponse, responses=LISTING_RESPONSES)
 def get_uses(
+    request: Request,
+    response: Response,
     n_last: int = Query(100, ge=1, le=10000),
     since: Optional[datetime] = None,
     bag_id: Optional[str] = None,
 ) -> UseResponse:
-    return query_coffee_uses_db(n_last=n_last, since=since, bag_id=bag_id)
+    uses = query_coffee_uses_db(n_last=n_last, since=since, bag_id=bag_id)
+    return format_listing(request, response, uses, use_columns)
 
 
 @app.get("/number_of_uses/", response_model=int)
@@ -367,8 +1269,105 @@ def get_number_of_uses(
     if since is None and bag_id is None:
         return num_coffee_uses()
 
-    uses = query_coffee_uses_db(since=since, bag_id=bag_id)
-    return len(uses.keys())
+    return count_coffee_uses(since=since, bag_id=bag_id)
+
+
+@app.get("/dashboard/", response_model=DashboardResponse)
+async def get_dashboard(n_last: int = Query(10, ge=1, le=10000)) -> DashboardResponse:
+    # The meta record is read only once and passed on; the independent reads
+    # then run concurrently, with the uses of all active bags counted at once.
+    meta = await run_in_threadpool(get_meta_info)
+    n_bags = meta[MetaDataField.bag_count]
+    n_uses = meta[MetaDataField.use_count]
+
+    recent_uses, active_bags = await asyncio.gather(
+        run_in_threadpool(query_coffee_uses_db, n_last=n_last, meta=meta),
+        run_in_threadpool(active_coffee_bags),
+    )
+    counts = await run_in_threadpool(
+        count_coffee_uses_by_bag, list(active_bags.keys()), meta=meta
+    )
+
+    return DashboardResponse(
+        active_bags=active_bags,
+        recent_uses=recent_uses,
+        number_of_bags=n_bags,
+        number_of_uses=n_uses,
+        active_bag_uses=counts,
+    )
+
+
+#### ---- Snapshot ---- ####
+
+
+@app.get(
+    "/snapshot/",
+    response_class=Response,
+    responses={200: {"content": {"application/gzip": {}}}},
+    response_description="All bags and uses as gzip-compressed columnar JSON.",
+)
+def get_snapshot(request: Request) -> Response:
+    try:
+        snapshot = tenant_snapshots(current_tenant()).get()
+    except Exception as err:
+        raise_server_error(err)
+
+    headers = {
+        "ETag": snapshot.etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-cache",
+        "Content-Disposition": 'attachment; filename="coffee-snapshot.json.gz"',
+    }
+    if etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # A range of an outdated snapshot is useless, so `If-Range` falls back to
+    # sending the whole snapshot.
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and if_range in (None, snapshot.etag):
+        try:
+            byte_range = parse_range(range_header, snapshot.size)
+        except ValueError:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={"Content-Range": f"bytes */{snapshot.size}"},
+            )
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{snapshot.size}"
+            return Response(
+                snapshot.data[start : end + 1],
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                media_type="application/gzip",
+                headers=headers,
+            )
+
+    return Response(snapshot.data, media_type="application/gzip", headers=headers)
+
+
+#### ---- Changes ---- ####
+
+
+@app.get("/changes/", response_model=ChangePage)
+def get_changes(
+    after: int = Query(0, ge=0), limit: int = Query(1000, ge=1, le=1000)
+) -> ChangePage:
+    # Pass `last` of a page as `after` to get the next changes.
+    return change_log.read(after=after, limit=limit)
+
+
+#### ---- Events ---- ####
+
+
+@app.get("/events/", response_description="A stream of Server-Sent Events.")
+async def get_events() -> StreamingResponse:
+    # One event per put, update or delete of a bag ("bags") or use ("uses").
+    return StreamingResponse(
+        event_stream(broadcaster, tenant=current_tenant()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 #### ---- Setters ---- ####
@@ -384,6 +1383,7 @@ def add_new_bag(bag: CoffeeBag, password: str) -> Dict[str, CoffeeBag]:
     except Exception as err:
         raise_server_error(err)
 
+    publish_bag_change(ChangeOp.put, bag)
     return {bag._key: bag}
 
 
@@ -398,13 +1398,17 @@ def add_new_use(
         raise_bag_not_found(bag_id)
 
     new_coffee_use = CoffeeUse(bag_id=bag_id, datetime=when)
+    use_info = convert_use_to_info(new_coffee_use)
 
     try:
-        coffee_use_db.put(convert_use_to_info(new_coffee_use))
+        coffee_use_db.put(use_info)
         increment_coffee_use(1)
     except Exception as err:
         raise_server_error(err)
 
+    publish_change(
+        Collection.uses, ChangeOp.put, key=new_coffee_use._key, data=use_info
+    )
     return {new_coffee_use._key: new_coffee_use}
 
 
@@ -425,7 +1429,9 @@ def deactivate_bag(
             updates={"finish": jsonable_encoder(when), "active": False},
             key=bag_info["key"],
         )
-        return {bag_id: convert_info_to_bag(bag_info)}
+        bag = convert_info_to_bag(bag_info)
+        publish_bag_change(ChangeOp.update, bag)
+        return {bag_id: bag}
     else:
         raise HTTPException(
             status.HTTP_400_BAD_REQUEST,
@@ -454,7 +1460,9 @@ def activate_bag(bag_id: str, password: str) -> BagResponse:
         updates={"finish": None, "active": True},
         key=bag_id,
     )
-    return {bag_id: convert_info_to_bag(bag_info)}
+    bag = convert_info_to_bag(bag_info)
+    publish_bag_change(ChangeOp.update, bag)
+    return {bag_id: bag}
 
 
 @app.patch("/update_bag/{bag_id}", response_model=BagResponse)
@@ -483,46 +1491,155 @@ def update_bag(bag_id: str, field: str, value: Any, password: str) -> BagRespons
         )
 
     coffee_bag_db.update({field: value}, key=bag_id)
+    publish_bag_change(ChangeOp.update, bag)
     return {bag._key: bag}
 
 
-def _delete_coffee_bag(bag_id: str):
-    if coffee_bag_db.get(bag_id) is not None:
-        coffee_bag_db.delete(bag_id)
-        increment_coffee_bag(by=-1)
+def validate_bag_update(
+    bag_id: str, bag_info: Optional[Dict[str, Any]], update: BagUpdate
+) -> BagUpdateResult:
+    if bag_info is None:
+        return BagUpdateResult(updated=False, error=f"Bag '{bag_id}' not found.")
+    bag_info.update(update.dict(exclude_unset=True))
+    try:
+        bag = convert_info_to_bag(bag_info)
+    except ValidationError as err:
+        return BagUpdateResult(updated=False, error=str(err))
+    return BagUpdateResult(updated=True, bag=bag)
+
+
+@app.patch("/update_bags/", response_model=BatchUpdateResponse)
+def update_bags(
+    updates: Dict[str, BagUpdate], password: str, all_or_nothing: bool = False
+) -> BatchUpdateResponse:
+    verify_password(password)
+
+    bag_ids = list(updates.keys())
+    bag_db = coffee_bag_db.resolve()
+    with phase("deta_get"), ThreadPoolExecutor(N_PARALLEL_QUERIES) as executor:
+        bag_infos = list(executor.map(bag_db.get, bag_ids))
+
+    results = {
+        bag_id: validate_bag_update(bag_id, info, updates[bag_id])
+        for bag_id, info in zip(bag_ids, bag_infos)
+    }
+    if all_or_nothing and not all(r.updated for r in results.values()):
+        for result in results.values():
+            result.updated = False
+            result.bag = None
+        return results
+
+    def write(bag: CoffeeBag) -> Optional[str]:
+        # Only the changed fields are written, with their validated values.
+        info = convert_bag_to_info(bag)
+        fields = updates[bag._key].dict(exclude_unset=True).keys()
+        if len(fields) == 0:
+            return None
+        try:
+            bag_db.update({f: info[f] for f in fields}, key=bag._key)
+        except Exception as err:
+            return str(err)
+        return None
+
+    bags = [r.bag for r in results.values() if r.bag is not None]
+    with phase("deta_update"), ThreadPoolExecutor(N_PARALLEL_QUERIES) as executor:
+        errors = list(executor.map(write, bags))
+
+    updated: List[Tuple[str, Optional[Dict[str, Any]]]] = []
+    for bag, error in zip(bags, errors):
+        if error is None:
+            updated.append((bag._key, convert_bag_to_info(bag)))
+        else:
+            results[bag._key] = BagUpdateResult(updated=False, error=error)
+    publish_changes(Collection.bags, ChangeOp.update, updated)
+    return results
+
+
+def _delete_coffee_uses(keys: List[str]) -> int:
+    # Deletes uses known to exist with a single adjustment of the use count.
+    delete_keys(coffee_use_db, keys)
+    if len(keys) > 0:
+        increment_coffee_use(by=-len(keys))
+    publish_deletes(Collection.uses, keys)
+    return len(keys)
+
+
+def existing_bag_ids(bag_ids: List[str]) -> Set[str]:
+    bag_db = resolve_base(coffee_bag_db)
+    with phase("deta_get"), ThreadPoolExecutor(N_PARALLEL_QUERIES) as executor:
+        bag_infos = list(executor.map(bag_db.get, bag_ids))
+    return {id for id, info in zip(bag_ids, bag_infos) if info is not None}
+
+
+def _delete_coffee_bags(bag_ids: List[str], cascade: bool = False):
+    # Deletes the bags (and their uses) with one adjustment of each count.
+    bag_ids = list(dict.fromkeys(bag_ids))
+    existing = existing_bag_ids(bag_ids)
+    keys = [id for id in bag_ids if id in existing]
+    delete_keys(coffee_bag_db, keys)
+    if len(keys) > 0:
+        increment_coffee_bag(by=-len(keys))
+    publish_deletes(Collection.bags, keys)
+    if cascade and len(bag_ids) > 0:
+        # One pass over the uses for all of the bags.
+        query = [{"bag_id": id} for id in bag_ids]
+        _delete_coffee_uses(coffee_use_keys(query=query))
+
+
+def _delete_coffee_bag(bag_id: str, cascade: bool = False):
+    _delete_coffee_bags([bag_id], cascade=cascade)
 
 
 @app.delete("/delete_bag/{bag_id}")
-def delete_bag(bag_id: str, password: str):
+def delete_bag(bag_id: str, password: str, cascade: bool = False):
     verify_password(password)
 
-    _delete_coffee_bag(bag_id=bag_id)
+    _delete_coffee_bag(bag_id=bag_id, cascade=cascade)
     return None
 
 
 @app.delete("/delete_bags/")
-def delete_bags(bag_ids: List[str], password: str):
+def delete_bags(bag_ids: List[str], password: str, cascade: bool = False):
     verify_password(password)
 
-    for id in bag_ids:
-        _delete_coffee_bag(bag_id=id)
+    _delete_coffee_bags(bag_ids=bag_ids, cascade=cascade)
     return None
 
 
 @app.delete("/delete_all_bags/")
-def delete_all_bags(password: str):
+def delete_all_bags(password: str, cascade: bool = False):
     verify_password(password)
 
-    for bag_info in get_all_coffee_bag_info():
-        coffee_bag_db.delete(bag_info["key"])
+    keys = [bag_info["key"] for bag_info in get_all_detabase_info(coffee_bag_db)]
+    for key in keys:
+        coffee_bag_db.delete(key)
     reset_coffee_bag_count()
+    publish_deletes(Collection.bags, keys)
+
+    if cascade:
+        _delete_all_coffee_uses()
     return None
 
 
 def _delete_coffee_use(id: str):
-    if coffee_use_db.get(id) is not None:
+    info = coffee_use_db.get(id)
+    if info is not None:
         coffee_use_db.delete(id)
+
+    # A use older than the horizon may be in the archive (as well).
+    archived: List[str] = []
+    meta = read_meta_info()
+    horizon = get_archive_horizon(meta)
+    if horizon is not None and (info is None or info["_seconds"] < horizon):
+        generation = get_archive_generation(meta)
+        archived = get_archive().delete([id], horizon=horizon, generation=generation)
+        if len(archived) > 0:
+            # Other processes list the segments again.
+            bump_archive_generation()
+
+    if info is not None or len(archived) > 0:
         increment_coffee_use(by=-1)
+        publish_change(Collection.uses, ChangeOp.delete, key=id)
 
 
 @app.delete("/delete_use/{id}")
@@ -542,11 +1659,138 @@ def delete_uses(ids: List[str], password: str):
     return None
 
 
+def _delete_all_coffee_uses():
+    keys = [use_info["key"] for use_info in get_all_coffee_use_info()]
+    delete_keys(coffee_use_db, keys)
+    meta = read_meta_info()
+    if get_archive_horizon(meta) is not None:
+        # Archived uses need tombstones as well.
+        archived = archived_coffee_use_info(meta=meta)
+        keys = list(set(keys).union(info["key"] for info in archived))
+    get_archive().delete_all()
+    set_archive_horizon(None)
+    reset_coffee_use_count()
+    publish_deletes(Collection.uses, keys)
+
+
 @app.delete("/delete_all_uses/")
 def delete_all_uses(password: str):
     verify_password(password)
 
-    for use_info in get_all_coffee_use_info():
-        coffee_use_db.delete(use_info["key"])
-    reset_coffee_use_count()
+    _delete_all_coffee_uses()
+    return None
+
+
+def compact_coffee_uses() -> int:
+    # Remove the uses of bags that no longer exist in a single pass over the
+    # uses, deleting the orphans of each page as it arrives.
+    live_bags = {info["key"] for info in get_all_detabase_info(coffee_bag_db)}
+    orphans: List[str] = []
+    for page in fetch_pages(coffee_use_db):
+        page_orphans = [info for info in page if info["bag_id"] not in live_bags]
+        # A bag created since the bags were read is not an orphan's bag.
+        bag_ids = list({info["bag_id"] for info in page_orphans})
+        live_bags |= existing_bag_ids(bag_ids)
+        page_orphans = [
+            info for info in page_orphans if info["bag_id"] not in live_bags
+        ]
+        delete_keys(coffee_use_db, [info["key"] for info in page_orphans])
+        orphans += [info["key"] for info in page_orphans]
+
+    if len(orphans) > 0:
+        increment_coffee_use(by=-len(orphans))
+    publish_deletes(Collection.uses, orphans)
+    return len(orphans)
+
+
+@app.delete("/orphaned_uses/", response_model=int)
+def delete_orphaned_uses(password: str) -> int:
+    verify_password(password)
+
+    return compact_coffee_uses()
+
+
+@app.post("/archive_uses/", response_model=int)
+def archive_uses(
+    password: str, horizon_days: int = Query(ARCHIVE_HORIZON_DAYS, ge=1)
+) -> int:
+    verify_password(password)
+
+    try:
+        return archive_coffee_uses(horizon_days=horizon_days)
+    except Exception as err:
+        raise_server_error(err)
+    return 0
+
+
+#### ---- Backend metrics ---- ####
+
+
+@app.get("/backend_metrics/", response_model=Dict[str, BackendStats])
+def get_backend_metrics(password: str) -> Dict[str, BackendStats]:
+    verify_admin_password(password)
+    stats: Dict[str, BackendStats] = {}
+    for db in (coffee_bag_db, coffee_use_db, meta_db, change_db, tenant_db):
+        for base in db.handles().values():
+            if isinstance(base, ResilientBase):
+                stats[base.name] = base.stats()
+    return stats
+
+
+@app.get("/cache_stats/", response_model=CacheStats)
+def get_cache_stats(password: str) -> CacheStats:
+    verify_admin_password(password)
+    return cache.stats()
+
+
+#### ---- Tenant management ---- ####
+
+
+@app.get("/tenants/", response_model=List[str])
+def get_tenants(password: str) -> List[str]:
+    verify_admin_password(password)
+    return tenant_registry.names()
+
+
+@app.put("/tenants/{name}", response_model=str)
+def add_tenant(name: str, tenant_password: str, password: str) -> str:
+    verify_admin_password(password)
+    if not valid_tenant_name(name):
+        raise_invalid_tenant_name(name)
+    tenant_registry.put(name, get_pwd_context().hash(tenant_password))
+    return name
+
+
+@app.delete("/tenants/{name}")
+def delete_tenant(name: str, password: str):
+    # The tenant's collections are kept.
+    verify_admin_password(password)
+    if tenant_registry.get(name) is None:
+        raise_tenant_not_found(name)
+    tenant_registry.delete(name)
+    return None
+
+
+#### ---- Profiles ---- ####
+
+
+@app.get("/profiles/", response_model=List[RequestProfile])
+def get_profiles(password: str) -> List[RequestProfile]:
+    verify_admin_password(password)
+    return profile_store.list()
+
+
+@app.get("/profiles/{id}", response_model=RequestProfile)
+def get_profile(id: str, password: str) -> RequestProfile:
+    verify_admin_password(password)
+    profile = profile_store.get(id)
+    if profile is None:
+        raise_profile_not_found(id)
+    return profile
+
+
+@app.delete("/profiles/")
+def delete_profiles(password: str):
+    verify_admin_password(password)
+    profile_store.clear()
     return None
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Streaming reads of a Deta Base.
+#
+# `iter_pages()` follows the `last` cursor that Deta returns with every page
+# until the backend says there are no more, instead of asking for a number of
+# pages guessed from the item counts. As soon as the cursor of a page is known
+# the next page is requested in the background, so its round trip overlaps
+# with whatever the caller does with the current page. Pages are only read as
+# they are consumed: a caller that stops early leaves the rest unread.
+#
+# The prefetches run in worker threads, which do not see the caller's context
+# variables (e.g. the tenant), so the base handed in must already be resolved.
+#
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+
+from profiler import phase
+
+DEFAULT_BUFFER = 300
+N_PREFETCH_WORKERS = 16
+
+_executor = ThreadPoolExecutor(N_PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+Query = Union[Dict[str, Any], List[Dict[str, Any]]]
+Page = List[Dict[str, Any]]
+
+
+def _fetch_page(
+    db: Any, query: Optional[Query], buffer: int, last: Optional[str]
+) -> Tuple[Page, Optional[str]]:
+    _, res = db._fetch(query, buffer, last)
+    return res["items"], res["paging"].get("last")
+
+
+def iter_pages(
+    db: Any,
+    query: Optional[Query] = None,
+    buffer: int = DEFAULT_BUFFER,
+    prefetch: bool = True,
+) -> Generator[Page, None, None]:
+    upcoming: Optional["Future[Tuple[Page, Optional[str]]]"] = None
+    with phase("deta_fetch"):
+        items, last = _fetch_page(db, query, buffer, None)
+    try:
+        while True:
+            if last is not None and prefetch:
+                upcoming = _executor.submit(_fetch_page, db, query, buffer, last)
+            yield items
+            if last is None:
+                return
+            with phase("deta_fetch"):
+                if upcoming is None:
+                    items, last = _fetch_page(db, query, buffer, last)
+                else:
+                    items, last = upcoming.result()
+            upcoming = None
+    finally:
+        # The caller stopped early; a prefetch that already started is left to
+        # finish and its page is dropped.
+        if upcoming is not None:
+            upcoming.cancel()
+
+
+def iter_records(
+    db: Any,
+    query: Optional[Query] = None,
+    buffer: int = DEFAULT_BUFFER,
+    prefetch: bool = True,
+) -> Generator[Dict[str, Any], None, None]:
+    for page in iter_pages(db, query=query, buffer=buffer, prefetch=prefetch):
+        yield from page
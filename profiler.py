@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+# Opt-in, per-request profiling.
+#
+# A profiled request records the wall time spent in named phases (see `phase()`)
+# and runs its endpoint under `cProfile` to collect the most expensive
+# functions. Finished profiles are kept in a small in-memory ring buffer so
+# that latency outliers can be inspected through the API without redeploying.
+#
+
+import asyncio
+import cProfile
+import os
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+from urllib.parse import parse_qsl, urlencode
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+N_TOP_FUNCTIONS = 20
+SECRET_PARAMETERS = {"password", "tenant_password"}
+
+
+#### ---- Models ---- ####
+
+
+class FunctionTiming(BaseModel):
+    function: str
+    calls: int
+    own_ms: float
+    cumulative_ms: float
+
+
+class RequestProfile(BaseModel):
+    id: str
+    method: str
+    path: str
+    query: str = ""
+    started: datetime
+    status_code: Optional[int] = None
+    total_ms: float = 0.0
+    phases: Dict[str, float] = {}
+    top_functions: List[FunctionTiming] = []
+
+
+#### ---- Profiling sessions ---- ####
+
+
+class ProfilingSession:
+    def __init__(self, profile: RequestProfile) -> None:
+        self.profile = profile
+        self.profiler = cProfile.Profile()
+        self._lock = Lock()
+        self._start = time.perf_counter()
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self._lock:
+            phases = self.profile.phases
+            phases[name] = phases.get(name, 0.0) + seconds * 1000.0
+
+    @contextmanager
+    def profiler_enabled(self) -> Iterator[None]:
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # Another profiler is already active (e.g. a concurrent profiled
+            # request on Python >= 3.12); keep the phase timings only.
+            yield
+            return
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def finish(self) -> RequestProfile:
+        profile = self.profile
+        profile.total_ms = (time.perf_counter() - self._start) * 1000.0
+        # Everything outside of the endpoint itself: routing, request
+        # validation, and response validation and encoding.
+        endpoint_ms = profile.phases.get("endpoint", 0.0)
+        profile.phases["framework"] = max(profile.total_ms - endpoint_ms, 0.0)
+        profile.top_functions = _top_functions(self.profiler, N_TOP_FUNCTIONS)
+        profile_store.add(profile)
+        return profile
+
+
+_current_session: ContextVar[Optional[ProfilingSession]] = ContextVar(
+    "profiling_session", default=None
+)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    session = _current_session.get()
+    if session is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        session.add_phase(name, time.perf_counter() - start)
+
+
+def _function_name(code: Any) -> str:
+    filename, line, name = code
+    if filename == "~":
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def _top_functions(profiler: cProfile.Profile, n: int) -> List[FunctionTiming]:
+    profiler.create_stats()
+    stats: Dict[Any, Any] = profiler.stats  # type: ignore
+    ranked = sorted(stats.items(), key=lambda x: x[1][2], reverse=True)[:n]
+    return [
+        FunctionTiming(
+            function=_function_name(code),
+            calls=n_calls,
+            own_ms=own_time * 1000.0,
+            cumulative_ms=cum_time * 1000.0,
+        )
+        for code, (_, n_calls, own_time, cum_time, _) in ranked
+    ]
+
+
+def redact_query(query_string: bytes) -> str:
+    # Profiles are kept and listed, so passwords must not end up in them.
+    params = parse_qsl(query_string.decode(), keep_blank_values=True)
+    return urlencode(
+        [(k, "[REDACTED]" if k in SECRET_PARAMETERS else v) for k, v in params]
+    )
+
+
+def server_timing(profile: RequestProfile) -> str:
+    timings = [f"{name};dur={ms:.2f}" for name, ms in profile.phases.items()]
+    timings.append(f"total;dur={profile.total_ms:.2f}")
+    return ", ".join(timings)
+
+
+#### ---- Storage ---- ####
+
+
+class ProfileStore:
+    def __init__(self, maxlen: int) -> None:
+        self._profiles: Deque[RequestProfile] = deque(maxlen=maxlen)
+        self._lock = Lock()
+
+    def add(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._profiles.append(profile)
+
+    def list(self) -> List[RequestProfile]:
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def get(self, id: str) -> Optional[RequestProfile]:
+        with self._lock:
+            for profile in self._profiles:
+                if profile.id == id:
+                    return profile
+        return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._profiles.clear()
+
+
+profile_store = ProfileStore(maxlen=int(os.getenv("PROFILE_HISTORY", default="50")))
+
+
+#### ---- Middleware ---- ####
+
+PROFILE_HEADER = b"x-profile"
+
+
+class ProfilingMiddleware:
+    # Profiles a request if it carries the admin password in the `X-Profile`
+    # header or if it is randomly sampled. The profile id and the phase
+    # timings are returned in the `X-Profile-Id` and `Server-Timing` headers.
+    def __init__(
+        self, app: Any, authorize: Callable[[str], bool], sample_rate: float = 0.0
+    ) -> None:
+        self.app = app
+        self.authorize = authorize
+        self.sample_rate = sample_rate
+
+    async def should_profile(self, scope: Dict[str, Any]) -> bool:
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return await run_in_threadpool(self.authorize, value.decode())
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not await self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        session = ProfilingSession(
+            RequestProfile(
+                id=str(uuid.uuid4()),
+                method=scope["method"],
+                path=scope["path"],
+                query=redact_query(scope["query_string"]),
+                started=datetime.now(),
+            )
+        )
+
+        async def send_with_profile(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                profile = session.finish()
+                profile.status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile.id.encode()))
+                headers.append((b"server-timing", server_timing(profile).encode()))
+                message["headers"] = headers
+            await send(message)
+
+        token = _current_session.set(session)
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            _current_session.reset(token)
+
+
+#### ---- Routing ---- ####
+
+
+def profiled_endpoint(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+    if asyncio.iscoroutinefunction(endpoint):
+
+        @wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            session = _current_session.get()
+            if session is None:
+                return await endpoint(*args, **kwargs)
+            with phase("endpoint"), session.profiler_enabled():
+                return await endpoint(*args, **kwargs)
+
+        return async_wrapper
+
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        session = _current_session.get()
+        if session is None:
+            return endpoint(*args, **kwargs)
+        with phase("endpoint"), session.profiler_enabled():
+            return endpoint(*args, **kwargs)
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    # Runs the endpoint under the request's profiler (if there is one). Sync
+    # endpoints execute in a worker thread, so the profiler has to be enabled
+    # there rather than in the middleware.
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any) -> None:
+        super().__init__(path, profiled_endpoint(endpoint), **kwargs)
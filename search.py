@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# An in-memory search index over the brand and name of the bags.
+#
+# Brands and names are normalized (accents removed, case folded) and split
+# into tokens. A bag matches a query if every token of the query is a prefix
+# of one of the bag's tokens, e.g. "blue bot" finds "Blue Bottle", "Bottle
+# Blue Blend" and "Bluebird Botanicals". With fuzzy matching, a query token
+# also matches tokens that are close to it (`difflib`), e.g. "espreso". Bags
+# with exact token matches rank before bags with only prefix or fuzzy matches.
+#
+# The index is loaded from the backend once and then kept up to date with the
+# changes made through the API, so searches never touch the backend.
+#
+
+import difflib
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+SEARCH_FIELDS = ("brand", "name")
+
+EXACT_SCORE = 2.0
+PREFIX_SCORE = 1.0
+FUZZY_SCORE = 0.5
+FUZZY_CUTOFF = 0.75
+N_FUZZY_MATCHES = 5
+
+
+def normalize(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(normalize(text))
+
+
+def bag_tokens(info: Dict[str, Any]) -> Set[str]:
+    tokens: Set[str] = set()
+    for field in SEARCH_FIELDS:
+        value = info.get(field)
+        if isinstance(value, str):
+            tokens.update(tokenize(value))
+    return tokens
+
+
+class BagIndex:
+    def __init__(self) -> None:
+        self._infos: Dict[str, Dict[str, Any]] = {}
+        self._bag_tokens: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        self._tokens: List[str] = []  # sorted, for the prefix lookups
+        # The version of the index at the last change of each bag, so that
+        # loading does not undo changes made while the bags were being read.
+        self._version = 0
+        self._changed: Dict[str, int] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._infos)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def age(self) -> Optional[float]:
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    #### ---- Changes ---- ####
+
+    def _remove(self, key: str) -> None:
+        self._infos.pop(key, None)
+        for token in self._bag_tokens.pop(key, set()):
+            keys = self._postings[token]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._postings[token]
+                del self._tokens[bisect_left(self._tokens, token)]
+
+    def _add(self, key: str, info: Dict[str, Any]) -> None:
+        self._remove(key)
+        tokens = bag_tokens(info)
+        self._infos[key] = info
+        self._bag_tokens[key] = tokens
+        for token in tokens:
+            keys = self._postings.get(token)
+            if keys is None:
+                keys = self._postings[token] = set()
+                insort(self._tokens, token)
+            keys.add(key)
+
+    def add(self, key: str, info: Dict[str, Any]) -> None:
+        with self._lock:
+            self._version += 1
+            self._changed[key] = self._version
+            self._add(key, info)
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            self._version += 1
+            self._changed[key] = self._version
+            self._remove(key)
+
+    def load(self, infos: List[Dict[str, Any]], version: int) -> None:
+        # `version` is the version of the index from before `infos` were read.
+        with self._lock:
+            kept: Dict[str, Optional[Dict[str, Any]]] = {
+                key: self._infos.get(key)
+                for key, changed in self._changed.items()
+                if changed > version
+            }
+            self._infos, self._bag_tokens = {}, {}
+            self._postings, self._tokens = {}, []
+            for info in infos:
+                if info["key"] not in kept:
+                    self._add(info["key"], info)
+            for key, kept_info in kept.items():
+                if kept_info is not None:
+                    self._add(key, kept_info)
+            self._changed = {k: v for k, v in self._changed.items() if v > version}
+            self._loaded_at = time.monotonic()
+
+    #### ---- Queries ---- ####
+
+    def _prefix_matches(self, prefix: str) -> List[str]:
+        matches: List[str] = []
+        for i in range(bisect_left(self._tokens, prefix), len(self._tokens)):
+            if not self._tokens[i].startswith(prefix):
+                break
+            matches.append(self._tokens[i])
+        return matches
+
+    def _token_scores(self, query_token: str, fuzzy: bool) -> Dict[str, float]:
+        # The best score of each bag for one token of the query.
+        scores: Dict[str, float] = {}
+
+        def score(tokens: List[str], value: float) -> None:
+            for token in tokens:
+                for key in self._postings[token]:
+                    scores[key] = max(scores.get(key, 0.0), value)
+
+        if fuzzy:
+            close = difflib.get_close_matches(
+                query_token, self._tokens, n=N_FUZZY_MATCHES, cutoff=FUZZY_CUTOFF
+            )
+            score(close, FUZZY_SCORE)
+        score(self._prefix_matches(query_token), PREFIX_SCORE)
+        if query_token in self._postings:
+            score([query_token], EXACT_SCORE)
+        return scores
+
+    def search(
+        self, query: str, limit: int = 20, fuzzy: bool = False
+    ) -> List[Dict[str, Any]]:
+        query_tokens = tokenize(query)
+        if len(query_tokens) == 0:
+            return []
+        with self._lock:
+            totals: Optional[Dict[str, float]] = None
+            for query_token in set(query_tokens):
+                scores = self._token_scores(query_token, fuzzy=fuzzy)
+                if totals is None:
+                    totals = scores
+                else:
+                    totals = {
+                        k: v + scores[k] for k, v in totals.items() if k in scores
+                    }
+                if len(totals) == 0:
+                    return []
+            infos = self._infos
+
+            def rank(key: str) -> Tuple[float, str, str]:
+                info = infos[key]
+                name = normalize(f"{info.get('brand', '')} {info.get('name', '')}")
+                return (-totals[key], name, key)  # type: ignore
+
+            keys = sorted(totals or {}, key=rank)[:limit]
+            return [dict(infos[key]) for key in keys]
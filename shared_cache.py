@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+# A cache shared by the worker processes of one host.
+#
+# Entries live in namespaces (one per tenant). A write invalidates its whole
+# namespace, which bumps the namespace's generation; a value computed before
+# the write (i.e. read with an older generation) is not stored afterwards, so
+# readers never see data older than the last write once it is invalidated.
+#
+# `LocalCache` keeps the entries in the process. `SharedCache` shares one
+# `LocalCache` between processes over a unix socket: the first process that
+# takes the lock file next to the socket serves the cache from a background
+# thread and the others connect to it. If the serving process goes away, the
+# next one to notice takes over. Until a server is reachable again a process
+# does not cache at all: it would not see the other processes' invalidations.
+#
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+try:
+    import fcntl
+except ImportError:
+    # On Windows every process keeps its own cache.
+    fcntl = None  # type: ignore
+
+N_MAX_ENTRIES = 4096
+SOCKET_TIMEOUT = 1.0
+RETRY_SERVER_AFTER = 5.0
+
+CacheResult = Tuple[Optional[bytes], int]
+
+
+class CacheStats(BaseModel):
+    shared: bool
+    server: bool
+    entries: int
+    hits: int
+    misses: int
+    sets: int
+    stale_sets: int
+    invalidations: int
+    hit_rate: float
+
+
+#### ---- Local cache ---- ####
+
+
+class LocalCache:
+    def __init__(self, max_entries: int = N_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        # (namespace, key) -> (expiry, value), least recently used first.
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, bytes]]" = (
+            OrderedDict()
+        )
+        self._generations: Dict[str, int] = {}
+        self.counts = {
+            "hits": 0,
+            "misses": 0,
+            "sets": 0,
+            "stale_sets": 0,
+            "invalidations": 0,
+        }
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> CacheResult:
+        with self._lock:
+            generation = self._generations.get(namespace, 0)
+            entry = self._entries.get((namespace, key))
+            if entry is None or entry[0] < time.monotonic():
+                self.counts["misses"] += 1
+                return None, generation
+            self._entries.move_to_end((namespace, key))
+            self.counts["hits"] += 1
+            return entry[1], generation
+
+    def set(
+        self, namespace: str, key: str, value: bytes, ttl: float, generation: int
+    ) -> bool:
+        with self._lock:
+            if generation != self._generations.get(namespace, 0):
+                # The namespace was invalidated while the value was computed.
+                self.counts["stale_sets"] += 1
+                return False
+            self._entries[(namespace, key)] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.counts["sets"] += 1
+            return True
+
+    def invalidate(self, namespace: str) -> int:
+        with self._lock:
+            generation = self._generations.get(namespace, 0) + 1
+            self._generations[namespace] = generation
+            for key in [k for k in self._entries if k[0] == namespace]:
+                del self._entries[key]
+            self.counts["invalidations"] += 1
+            return generation
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            # Generations only ever increase, so pending sets stay rejected.
+            for namespace in self._generations:
+                self._generations[namespace] += 1
+
+    def stats(self, shared: bool = False, server: bool = False) -> CacheStats:
+        with self._lock:
+            counts = dict(self.counts)
+            entries = len(self._entries)
+        lookups = max(counts["hits"] + counts["misses"], 1)
+        return CacheStats(
+            shared=shared,
+            server=server,
+            entries=entries,
+            hit_rate=counts["hits"] / lookups,
+            **counts,
+        )
+
+
+#### ---- Protocol ---- ####
+
+# A message is a length-prefixed JSON header followed by a length-prefixed
+# binary value (empty if there is none).
+
+_LENGTH = struct.Struct(">I")
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Cache connection closed.")
+        data += chunk
+    return bytes(data)
+
+
+def send_message(
+    sock: socket.socket, header: Dict[str, Any], value: bytes = b""
+) -> None:
+    encoded = json.dumps(header).encode()
+    sock.sendall(
+        _LENGTH.pack(len(encoded)) + encoded + _LENGTH.pack(len(value)) + value
+    )
+
+
+def _recv_part(sock: socket.socket) -> bytes:
+    (n,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    return _recv_exactly(sock, n)
+
+
+def recv_message(sock: socket.socket) -> Tuple[Dict[str, Any], bytes]:
+    header = json.loads(_recv_part(sock))
+    return header, _recv_part(sock)
+
+
+def handle_message(
+    cache: LocalCache, header: Dict[str, Any], value: bytes
+) -> Tuple[Dict[str, Any], bytes]:
+    op = header["op"]
+    if op == "get":
+        found, generation = cache.get(header["namespace"], header["key"])
+        return {"found": found is not None, "generation": generation}, found or b""
+    if op == "set":
+        stored = cache.set(
+            header["namespace"],
+            header["key"],
+            value,
+            ttl=header["ttl"],
+            generation=header["generation"],
+        )
+        return {"stored": stored}, b""
+    if op == "invalidate":
+        return {"generation": cache.invalidate(header["namespace"])}, b""
+    if op == "clear":
+        cache.clear()
+        return {}, b""
+    if op == "stats":
+        return cache.stats(shared=True, server=True).dict(), b""
+    return {"error": f"Unknown operation '{op}'."}, b""
+
+
+#### ---- Server ---- ####
+
+
+class _CacheRequestHandler(socketserver.BaseRequestHandler):
+    def setup(self) -> None:
+        self.server.connections.add(self.request)  # type: ignore
+
+    def finish(self) -> None:
+        self.server.connections.discard(self.request)  # type: ignore
+
+    def handle(self) -> None:
+        cache: LocalCache = self.server.cache  # type: ignore
+        while True:
+            try:
+                header, value = recv_message(self.request)
+                send_message(self.request, *handle_message(cache, header, value))
+            except (ConnectionError, OSError):
+                return
+
+
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, cache: LocalCache) -> None:
+        self.cache = cache
+        self.connections: Set[socket.socket] = set()
+        super().__init__(path, _CacheRequestHandler)
+
+    def close(self) -> None:
+        # Like the end of the process: the clients see their connections close.
+        self.shutdown()
+        self.server_close()
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+#### ---- Shared cache ---- ####
+
+
+class SharedCache:
+    def __init__(self, path: str, max_entries: int = N_MAX_ENTRIES) -> None:
+        self.path = path
+        self.local = LocalCache(max_entries=max_entries)
+        self.server: Optional[CacheServer] = None
+        self._lock_file: Optional[Any] = None
+        self._retry_at = 0.0
+        self._connections = threading.local()
+        self._elect_lock = threading.Lock()
+
+    def _serve(self) -> bool:
+        # Serve the cache from this process if no other process does.
+        if fcntl is None:
+            return False
+        with self._elect_lock:
+            if self.server is not None:
+                return True
+            lock_file = open(self.path + ".lock", "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            if os.path.exists(self.path):
+                # Left behind by a server that is gone (it held the lock).
+                os.unlink(self.path)
+            # Its entries and generations predate writes that no server saw.
+            self.local.clear()
+            self.server = CacheServer(self.path, self.local)
+            self._lock_file = lock_file
+            thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+            thread.start()
+            return True
+
+    def _connection(self) -> socket.socket:
+        sock: Optional[socket.socket] = getattr(self._connections, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(SOCKET_TIMEOUT)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._connections.sock = sock
+        return sock
+
+    def _disconnect(self) -> None:
+        sock: Optional[socket.socket] = getattr(self._connections, "sock", None)
+        if sock is not None:
+            sock.close()
+        self._connections.sock = None
+
+    def _request(
+        self, header: Dict[str, Any], value: bytes = b""
+    ) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        # Returns None if this process serves the cache itself (the local cache
+        # is used instead) or no server is reachable.
+        if self.server is not None or time.monotonic() < self._retry_at:
+            return None
+        for _ in range(2):
+            try:
+                sock = self._connection()
+                send_message(sock, header, value)
+                return recv_message(sock)
+            except (ConnectionError, OSError, ValueError):
+                self._disconnect()
+                if self._serve():
+                    return None
+        self._retry_at = time.monotonic() + RETRY_SERVER_AFTER
+        return None
+
+    @property
+    def shared(self) -> bool:
+        return self.server is not None or time.monotonic() >= self._retry_at
+
+    def get(self, namespace: str, key: str) -> CacheResult:
+        res = self._request({"op": "get", "namespace": namespace, "key": key})
+        if res is None and self.server is None:
+            # Without a server every lookup misses.
+            return None, 0
+        if res is None:
+            return self.local.get(namespace, key)
+        header, value = res
+        return (value if header["found"] else None), header["generation"]
+
+    def set(
+        self, namespace: str, key: str, value: bytes, ttl: float, generation: int
+    ) -> bool:
+        header = {
+            "op": "set",
+            "namespace": namespace,
+            "key": key,
+            "ttl": ttl,
+            "generation": generation,
+        }
+        res = self._request(header, value)
+        if res is None and self.server is None:
+            return False
+        if res is None:
+            return self.local.set(namespace, key, value, ttl, generation=generation)
+        return res[0]["stored"]
+
+    def invalidate(self, namespace: str) -> int:
+        # The local cache is invalidated as well, in case this process serves
+        # it later on.
+        generation = self.local.invalidate(namespace)
+        res = self._request({"op": "invalidate", "namespace": namespace})
+        return generation if res is None else res[0]["generation"]
+
+    def clear(self) -> None:
+        self.local.clear()
+        self._request({"op": "clear"})
+
+    def stats(self) -> CacheStats:
+        res = self._request({"op": "stats"})
+        if res is None:
+            return self.local.stats(shared=self.shared, server=self.server is not None)
+        stats = CacheStats(**res[0])
+        stats.server = False
+        return stats
+
+    def close(self) -> None:
+        self._disconnect()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            os.unlink(self.path)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
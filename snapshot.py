@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# A materialized snapshot of all bags and uses for analytics clients.
+#
+# The snapshot is a gzip-compressed JSON document with one array per column:
+#
+#   {"created": "...", "bags": {"key": [...], "brand": [...], ...},
+#    "uses": {"key": [...], "bag_id": [...], "datetime": [...]}}
+#
+# It is rebuilt in a background thread shortly after the last write (writes in
+# quick succession are debounced into one rebuild) and served as-is, so a
+# client downloads the whole dataset without any per-row work on the server.
+#
+
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+SNAPSHOT_BAG_FIELDS = ["key", "brand", "name", "weight", "start", "finish", "active"]
+SNAPSHOT_USE_FIELDS = ["key", "bag_id", "datetime"]
+
+Columns = Dict[str, List[Any]]
+
+
+#### ---- Encoding ---- ####
+
+
+def to_columns(infos: List[Dict[str, Any]], fields: List[str]) -> Columns:
+    return {field: [info.get(field) for info in infos] for field in fields}
+
+
+def encode_snapshot(
+    bags: List[Dict[str, Any]], uses: List[Dict[str, Any]], created: datetime
+) -> bytes:
+    uses = sorted(uses, key=lambda x: x["_seconds"])
+    document = {
+        "created": created.isoformat(),
+        "bags": to_columns(bags, SNAPSHOT_BAG_FIELDS),
+        "uses": to_columns(uses, SNAPSHOT_USE_FIELDS),
+    }
+    data = json.dumps(document, separators=(",", ":")).encode()
+    # `mtime=0` keeps the bytes (and so the ETag) identical for identical data.
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as file:
+        file.write(data)
+    return buffer.getvalue()
+
+
+def decode_snapshot(data: bytes) -> Dict[str, Any]:
+    return json.loads(gzip.decompress(data))
+
+
+class Snapshot:
+    def __init__(self, data: bytes, created: datetime) -> None:
+        self.data = data
+        self.created = created
+        self.etag = '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+        self._built_at = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self._built_at
+
+
+#### ---- Materialization ---- ####
+
+
+class SnapshotMaterializer:
+    def __init__(
+        self,
+        build: Callable[[], Snapshot],
+        delay: float = 5.0,
+        max_delay: float = 60.0,
+        max_age: Optional[float] = None,
+    ) -> None:
+        self.build = build
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self._snapshot: Optional[Snapshot] = None
+        self._timer: Optional[threading.Timer] = None
+        self._dirty_since: Optional[float] = None
+        self._requested = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    @property
+    def requested(self) -> bool:
+        # Only a snapshot that has been asked for is rebuilt after writes.
+        return self._requested
+
+    def get(self) -> Snapshot:
+        self._requested = True
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.refresh()
+        stale = self.max_age is not None and snapshot.age > self.max_age
+        if stale and self._dirty_since is None:
+            # Serve the stale snapshot while a fresh one is built, so that
+            # changes made by other instances are picked up eventually.
+            self.mark_dirty(delay=0.0)
+        return snapshot
+
+    def mark_dirty(self, delay: Optional[float] = None) -> None:
+        delay = self.delay if delay is None else delay
+        now = time.monotonic()
+        with self._lock:
+            if self._dirty_since is None:
+                self._dirty_since = now
+            elif self._timer is not None:
+                if now - self._dirty_since + delay > self.max_delay:
+                    # Constant writes must not postpone the rebuild forever.
+                    return
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, self._rebuild)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _rebuild(self) -> None:
+        try:
+            self.refresh()
+        except Exception as err:
+            print(f"Snapshot rebuild failed: {err}")
+
+    def refresh(self) -> Snapshot:
+        with self._build_lock:
+            with self._lock:
+                self._dirty_since = None
+                self._timer = None
+            snapshot = self.build()
+            self._snapshot = snapshot
+        return snapshot
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            self._dirty_since = None
+
+    def clear(self) -> None:
+        self.cancel()
+        self._snapshot = None
+        self._requested = False
+
+
+#### ---- Conditional and range requests ---- ####
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    # Weak comparison, as used for `If-None-Match`.
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [t.strip() for t in header.split(",")]
+    return etag in [t[2:] if t.startswith("W/") else t for t in tags]
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    # Returns the inclusive byte range of a single-range `Range` header, or None
+    # if the whole snapshot should be sent instead (an unsupported unit or
+    # several ranges). Raises `ValueError` if the range is not satisfiable.
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, sep, last = ranges.strip().partition("-")
+    if sep != "-" or (first == "" and last == ""):
+        return None
+    if not all(x == "" or x.isdigit() for x in (first, last)):
+        return None
+    if first == "":
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError(f"Range {header} is empty.")
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    if last != "" and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(f"Range {header} not satisfiable for {size} bytes.")
+    end = size - 1 if last == "" else min(int(last), size - 1)
+    return start, end
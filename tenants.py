@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Tenants sharing one deployment.
+#
+# A request selects its tenant with the `X-Tenant` header (or the `tenant` query
+# parameter, e.g. for an `EventSource` that cannot set headers). The tenant is
+# kept in a context variable for the rest of the request, and every
+# partitioned collection resolves to the tenant's own collection
+# (`<name>-<tenant>`), so a tenant's queries never touch anyone else's data.
+# Requests without a tenant use the original, unsuffixed collections.
+#
+# Like the original collections, a tenant's collections can be read by anyone
+# who names the tenant; its password (checked per endpoint) is only required
+# for writes.
+#
+# Tenants and their hashed passwords are kept in a registry base, and lookups
+# are cached for a short while.
+#
+
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+from paging import iter_records
+
+TENANT_HEADER = b"x-tenant"
+TENANT_QUERY_PARAM = "tenant"
+TENANT_NAME_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+
+_current_tenant: ContextVar[Optional[str]] = ContextVar("tenant", default=None)
+
+
+def current_tenant() -> Optional[str]:
+    return _current_tenant.get()
+
+
+@contextmanager
+def tenant_scope(tenant: Optional[str]) -> Iterator[None]:
+    token = _current_tenant.set(tenant)
+    try:
+        yield
+    finally:
+        _current_tenant.reset(token)
+
+
+def valid_tenant_name(name: str) -> bool:
+    return TENANT_NAME_PATTERN.match(name) is not None
+
+
+def collection_name(name: str, tenant: Optional[str]) -> str:
+    return name if tenant is None else f"{name}-{tenant}"
+
+
+#### ---- Registry ---- ####
+
+
+class TenantRegistry:
+    def __init__(self, db: Any, ttl: float = 60.0) -> None:
+        self.db = db
+        self.ttl = ttl
+        self._cache: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
+        self._lock = Lock()
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cached = self._cache.get(name)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        info: Optional[Dict[str, Any]] = self.db.get(name)
+        with self._lock:
+            self._cache[name] = (time.monotonic(), info)
+        return info
+
+    def put(self, name: str, hashed_password: str) -> Dict[str, Any]:
+        info = self.db.put({"hashed_password": hashed_password}, key=name)
+        with self._lock:
+            self._cache[name] = (time.monotonic(), info)
+        return info
+
+    def delete(self, name: str) -> None:
+        self.db.delete(name)
+        with self._lock:
+            self._cache.pop(name, None)
+
+    def names(self) -> List[str]:
+        return sorted(info["key"] for info in iter_records(self.db, buffer=500))
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+#### ---- Middleware ---- ####
+
+
+def _requested_tenant(scope: Dict[str, Any]) -> Optional[str]:
+    for name, value in scope.get("headers", []):
+        if name == TENANT_HEADER:
+            return value.decode("latin-1")
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    values = query.get(TENANT_QUERY_PARAM)
+    return None if values is None else values[0]
+
+
+class TenantMiddleware:
+    def __init__(self, app: Any, exists: Callable[[str], bool]) -> None:
+        self.app = app
+        self.exists = exists
+
+    async def __call__(self, scope, receive, send) -> None:
+        tenant = _requested_tenant(scope) if scope["type"] == "http" else None
+        if tenant is None:
+            await self.app(scope, receive, send)
+            return
+
+        response: Optional[JSONResponse] = None
+        if not valid_tenant_name(tenant):
+            response = JSONResponse(
+                {"detail": f"Invalid tenant name '{tenant}'."}, status_code=400
+            )
+        elif not await run_in_threadpool(self.exists, tenant):
+            response = JSONResponse(
+                {"detail": f"Tenant '{tenant}' not found."}, status_code=404
+            )
+        if response is not None:
+            await response(scope, receive, send)
+            return
+
+        with tenant_scope(tenant):
+            await self.app(scope, receive, send)
@@ -1,9 +1,11 @@
 #!/usr/bun/env python3
 
+import asyncio
 from datetime import date, datetime, timedelta
 from random import choices, randint, random
 from string import printable
-from typing import Any, Dict
+from time import sleep
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import uuid1
 
 import pytest
@@ -11,8 +13,25 @@ from fastapi import HTTPException
 from fastapi.encoders import jsonable_encoder
 from fastapi.testclient import TestClient
 
+import formats
 import main
+import paging
+import profiler
+from archive import LocalDrive, SegmentArchive, decode_segment, encode_segment
+from backend import (
+    BackendTimeout,
+    BackendUnavailable,
+    CallPolicy,
+    CircuitBreaker,
+    ResilientBase,
+)
+from changes import SEQ_BLOCK, ChangeLog, SequenceGenerator
+from events import Broadcaster, ChangeOp, Collection, event_stream
+from local_base import LocalBase
 from main import CoffeeBag, CoffeeUse, app, today_at_midnight
+from search import BagIndex
+from shared_cache import LocalCache, SharedCache
+from snapshot import Snapshot, SnapshotMaterializer, decode_snapshot, parse_range
 
 client = TestClient(app)
 
@@ -27,6 +46,32 @@ def mock_use() -> CoffeeUse:
     return CoffeeUse(bag_id="BAG-ID", datetime=datetime.now())
 
 
+@pytest.fixture
+def local_databases(tmp_path):
+    # Replace the Deta bases and drive with local stand-ins for the test.
+    base_factory = main.base_factory
+    main.use_base_factory(LocalBase)
+    main.use_drive_factory(lambda name: LocalDrive(str(tmp_path / name)))
+    yield
+    main.use_base_factory(base_factory)
+    main.use_drive_factory(main.archive_drive)
+
+
+TEST_PASSWORD = "test-password"
+
+
+@pytest.fixture(scope="module")
+def hashed_password() -> str:
+    return main.get_pwd_context().hash(TEST_PASSWORD)
+
+
+@pytest.fixture
+def password(hashed_password: str, monkeypatch) -> str:
+    # Accept `TEST_PASSWORD` for writes during the test.
+    monkeypatch.setattr(main, "HASHED_PASSWORD", hashed_password)
+    return TEST_PASSWORD
+
+
 def mock_password() -> str:
     k = randint(10, 50)
     return "".join(choices(list(printable), k=k))
@@ -170,6 +215,312 @@ class TestModelDataModifiers:
 # sort_coffee_bags
 
 
+class TestLocalBase:
+    @pytest.fixture
+    def db(self) -> LocalBase:
+        db = LocalBase("test_db")
+        db.put_many([{"key": f"key-{i:02d}", "value": i} for i in range(25)])
+        return db
+
+    def test_put_get_delete(self, db: LocalBase):
+        item = db.put({"value": "new"})
+        assert db.get(item["key"]) == item
+        db.delete(item["key"])
+        assert db.get(item["key"]) is None
+
+    def test_update(self, db: LocalBase):
+        db.update({"value": db.util.increment(2), "other": "x"}, key="key-01")
+        assert db.get("key-01") == {"key": "key-01", "value": 3, "other": "x"}
+        db.update({"other": db.util.trim()}, key="key-01")
+        info = db.get("key-01")
+        assert info is not None and "other" not in info
+        with pytest.raises(Exception):
+            db.update({"value": 0}, key="not-a-key")
+
+    def test_fetch_pages(self, db: LocalBase):
+        pages = list(db.fetch(query=None, buffer=10, pages=10))
+        assert [len(p) for p in pages] == [10, 10, 5]
+        keys = [item["key"] for page in pages for item in page]
+        assert keys == sorted(keys)
+
+        pages = list(db.fetch(query=None, buffer=10, pages=2))
+        assert len(pages) == 2
+
+    def test_fetch_query(self, db: LocalBase):
+        items = [i for p in db.fetch(query={"value?gte": 20}) for i in p]
+        assert [i["value"] for i in items] == [20, 21, 22, 23, 24]
+        items = [i for p in db.fetch(query=[{"value": 1}, {"value?lt": 1}]) for i in p]
+        assert [i["value"] for i in items] == [0, 1]
+        items = [i for p in db.fetch(query={"key?pfx": "key-1"}) for i in p]
+        assert len(items) == 10
+
+
+class TestLazyBase:
+    def test_lazy_base_resolves_once(self, monkeypatch):
+        created = []
+
+        def factory(name: str) -> LocalBase:
+            created.append(name)
+            return LocalBase(name)
+
+        monkeypatch.setattr(main, "base_factory", factory)
+        db = main.LazyBase("lazy_db")
+        assert created == []
+        db.put({"value": 1}, key="a")
+        assert db.get("a") == {"key": "a", "value": 1}
+        assert created == ["lazy_db"]
+
+
+class CountingBase(LocalBase):
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.n_fetches = 0
+        self.n_inserts = 0
+        self.n_put_manys = 0
+
+    def _fetch(self, query=None, buffer=None, last=None):
+        self.n_fetches += 1
+        return super()._fetch(query, buffer, last)
+
+    def insert(self, data, key=None):
+        self.n_inserts += 1
+        return super().insert(data, key)
+
+    def put_many(self, items):
+        self.n_put_manys += 1
+        return super().put_many(items)
+
+
+class TestPaging:
+    @pytest.fixture
+    def db(self) -> CountingBase:
+        db = CountingBase("paging_db")
+        db.put_many([{"key": f"key-{i:02d}", "value": i} for i in range(25)])
+        return db
+
+    @pytest.mark.parametrize("prefetch", [True, False])
+    def test_pages_follow_cursor(self, db: CountingBase, prefetch: bool):
+        pages = list(paging.iter_pages(db, buffer=10, prefetch=prefetch))
+        assert [len(p) for p in pages] == [10, 10, 5]
+        assert db.n_fetches == 3
+        records = list(paging.iter_records(db, query={"value?gte": 20}, buffer=2))
+        assert [r["value"] for r in records] == [20, 21, 22, 23, 24]
+
+    def test_stop_early(self, db: CountingBase):
+        records = paging.iter_records(db, buffer=5)
+        assert [next(records)["key"] for _ in range(3)] == [
+            "key-00",
+            "key-01",
+            "key-02",
+        ]
+        records.close()
+        # The first page and at most the prefetched second one.
+        assert db.n_fetches <= 2
+
+    def test_active_bags_across_pages(self, local_databases):
+        bags = [CoffeeBag(brand="B", name=f"bag {i}") for i in range(350)]
+        main.coffee_bag_db.put_many([main.convert_bag_to_info(b) for b in bags])
+        main.coffee_bag_db.put(
+            main.convert_bag_to_info(CoffeeBag(brand="B", name="old", active=False))
+        )
+        assert set(main.active_coffee_bags().keys()) == {b._key for b in bags}
+        assert len(main.active_coffee_bags(n_last=3)) == 3
+
+
+class FlakyBase(LocalBase):
+    def __init__(
+        self, name: str, failures: int = 0, delays: Optional[List[float]] = None
+    ):
+        super().__init__(name)
+        self.failures = failures
+        self.delays = [] if delays is None else delays
+
+    def get(self, key: str):
+        if self.delays:
+            sleep(self.delays.pop(0))
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("Backend unreachable.")
+        return super().get(key)
+
+
+class TestResilientBase:
+    def test_retries_reads(self):
+        policy = CallPolicy(retries=2, backoff=0.001)
+        db = ResilientBase(FlakyBase("db", failures=2), name="db", policy=policy)
+        db.put({"key": "a", "value": 1})
+        assert db.get("a")["value"] == 1
+        stats = db.stats()
+        assert stats.retries == 2
+        assert stats.failures == 2
+        assert stats.state == "closed"
+
+    def test_retries_exhausted(self):
+        policy = CallPolicy(retries=1, backoff=0.001)
+        db = ResilientBase(FlakyBase("db", failures=5), name="db", policy=policy)
+        with pytest.raises(ConnectionError):
+            db.get("a")
+
+    def test_timeout(self):
+        policy = CallPolicy(timeout=0.05, retries=0, hedge_percentile=None)
+        db = ResilientBase(FlakyBase("db", delays=[0.5]), name="db", policy=policy)
+        with pytest.raises(BackendTimeout):
+            db.get("a")
+        assert db.stats().timeouts == 1
+
+    def test_hedged_read(self):
+        policy = CallPolicy(timeout=2.0, retries=0, min_hedge_samples=5)
+        db = ResilientBase(FlakyBase("db", delays=[1.0]), name="db", policy=policy)
+        for _ in range(5):
+            db.metrics.add_read_latency(0.01)
+        db.put({"key": "a", "value": 1})
+        start = datetime.now()
+        assert db.get("a")["value"] == 1
+        assert datetime.now() - start < timedelta(seconds=0.5)
+        assert db.stats().hedges == 1
+        assert db.stats().hedge_wins == 1
+
+    def test_circuit_breaker(self):
+        policy = CallPolicy(retries=0)
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.1)
+        base = FlakyBase("db", failures=3)
+        db = ResilientBase(base, name="db", policy=policy, breaker=breaker)
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                db.get("a")
+        with pytest.raises(BackendUnavailable):
+            db.get("a")
+        assert db.stats().state == "open"
+        assert db.stats().rejected == 1
+        sleep(0.15)
+        assert db.get("a") is None
+        assert db.stats().state == "closed"
+
+    def test_insert_conflicts_keep_breaker_closed(self):
+        breaker = CircuitBreaker(failure_threshold=3)
+        db = ResilientBase(LocalBase("db"), name="db", breaker=breaker)
+        db.insert({"key": "a"})
+        for _ in range(5):
+            with pytest.raises(Exception, match="already exists"):
+                db.insert({"key": "a"})
+        assert db.stats().state == "closed"
+        assert db.stats().failures == 0
+
+    def test_counters_kept_on_backend_error(self, local_databases):
+        main.increment_coffee_use(by=2)
+        assert main.read_meta_info()[main.MetaDataField.use_count] == 2
+
+        main.initialize_meta_db(bag_count=40, use_count=5000)
+        db = main.meta_db.resolve()
+        policy = CallPolicy(write_timeout=0.05)
+        main.meta_db._bases[None] = ResilientBase(db, name="meta_db", policy=policy)
+        db.update = lambda *args, **kwargs: sleep(0.2)
+        with pytest.raises(BackendTimeout):
+            main.increment_coffee_use(by=2)
+        meta = main.read_meta_info()
+        assert meta[main.MetaDataField.bag_count] == 40
+        assert meta[main.MetaDataField.use_count] == 5000
+
+    def test_unavailable_backend_response(self, local_databases):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        main.use_base_factory(
+            lambda name: ResilientBase(
+                FlakyBase(name, failures=10),
+                name=name,
+                policy=CallPolicy(retries=0),
+                breaker=breaker,
+            )
+        )
+        with pytest.raises(ConnectionError):
+            main.num_coffee_bags()
+        assert client.get("/bags/").status_code == 503
+        assert client.get("/number_of_bags/").status_code == 503
+
+
+#### ---- Cache ---- ####
+
+
+class TestSharedCache:
+    def test_local_cache(self, monkeypatch):
+        cache = LocalCache(max_entries=2)
+        value, generation = cache.get("", "a")
+        assert value is None
+        assert cache.set("", "a", b"1", ttl=60, generation=generation)
+        assert cache.get("", "a") == (b"1", generation)
+        # A value computed before an invalidation is not stored.
+        cache.invalidate("")
+        assert cache.get("", "a")[0] is None
+        assert not cache.set("", "a", b"2", ttl=60, generation=generation)
+        # Other namespaces are not affected by the invalidation.
+        cache.set("team", "a", b"3", ttl=60, generation=0)
+        cache.set("team", "b", b"4", ttl=0, generation=0)
+        assert cache.get("team", "b")[0] is None
+        cache.set("team", "c", b"5", ttl=60, generation=0)
+        cache.set("team", "d", b"6", ttl=60, generation=0)
+        assert cache.get("team", "a")[0] is None
+        assert cache.stats().entries == 2
+
+    def test_shared_between_processes(self, tmp_path):
+        path = str(tmp_path / "cache.sock")
+        first, second = SharedCache(path), SharedCache(path)
+        try:
+            _, generation = first.get("", "bags")
+            assert first.server is not None
+            assert second.set("", "bags", b"[]", ttl=60, generation=generation)
+            assert first.get("", "bags")[0] == b"[]"
+            second.invalidate("")
+            assert first.get("", "bags")[0] is None
+            assert second.server is None
+            assert second.stats().hits == 1
+
+            # The second cache takes over once the first one is gone, without
+            # the entries its fallback cached while it was not serving.
+            _, generation = second.local.get("", "uses")
+            assert second.local.set("", "uses", b"[]", ttl=60, generation=generation)
+            first.close()
+            assert second.get("", "uses")[0] is None
+            _, generation = second.get("", "bags")
+            assert second.server is not None
+            assert second.set("", "bags", b"[1]", ttl=60, generation=generation)
+            assert second.get("", "bags")[0] == b"[1]"
+        finally:
+            first.close()
+            second.close()
+
+    def test_no_caching_without_server(self, tmp_path):
+        fcntl = pytest.importorskip("fcntl")
+        path = str(tmp_path / "cache.sock")
+        with open(path + ".lock", "w") as lock_file:
+            # Another process holds the lock but its server is not reachable.
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            cache = SharedCache(path)
+            try:
+                value, generation = cache.get("", "bags")
+                assert value is None
+                assert cache.server is None
+                assert not cache.set("", "bags", b"[]", ttl=60, generation=generation)
+                assert cache.get("", "bags")[0] is None
+            finally:
+                cache.close()
+
+    def test_writes_invalidate(self, local_databases, password: str, monkeypatch):
+        monkeypatch.setattr(main, "CACHE_TTL", 60)
+        main.initialize_meta_db()
+        assert client.get("/number_of_bags/").json() == 0
+        assert client.get("/active_bags/").json() == {}
+
+        # Reads are served from the cache until a write commits.
+        main.meta_db.put({"bag_count": 5, "use_count": 0}, key=main.META_DB_KEY)
+        assert client.get("/number_of_bags/").json() == 0
+        bag = CoffeeBag(brand="Onyx", name="Geometry")
+        response = client.put(
+            f"/new_bag/?password={password}", json=jsonable_encoder(bag)
+        )
+        assert response.status_code == 200
+        assert client.get("/number_of_bags/").json() == 6
+        assert len(client.get("/active_bags/").json()) == 1
+
+
 #### ---- Meta Database ---- ####
 
 
@@ -186,6 +537,115 @@ class TestMetaDatabase:
         assert n_uses > 0
 
 
+#### ---- Archive ---- ####
+
+
+@pytest.mark.usefixtures("local_databases")
+class TestArchive:
+    @pytest.fixture
+    def use_keys(self) -> Dict[str, List[str]]:
+        keys: Dict[str, List[str]] = {"old": [], "new": []}
+        now = datetime.now()
+        for i in range(40):
+            age = "old" if i % 2 else "new"
+            days = 100 + i * 10 if age == "old" else i / 4
+            use = CoffeeUse(bag_id=f"BAG-{i % 3}", datetime=now - timedelta(days=days))
+            main.coffee_use_db.put(main.convert_use_to_info(use))
+            keys[age].append(use._key)
+        main.initialize_meta_db(bag_count=3, use_count=40)
+        return keys
+
+    def test_encode_decode_segment(self):
+        infos = [{"key": str(i), "bag_id": "BAG", "_seconds": i} for i in range(10)]
+        assert decode_segment(encode_segment(infos)) == infos
+
+    def test_archive_coffee_uses(self, use_keys: Dict[str, List[str]]):
+        assert main.archive_coffee_uses(horizon_days=30) == 20
+        assert len(main.coffee_use_db.resolve()) == 20
+        assert main.num_coffee_uses() == 40
+        assert main.get_archive_horizon() is not None
+        assert main.archive_coffee_uses(horizon_days=30) == 0
+
+    def test_query_merges_archive(self, use_keys: Dict[str, List[str]]):
+        main.archive_coffee_uses(horizon_days=30)
+
+        uses = main.query_coffee_uses_db()
+        assert set(uses.keys()) == set(use_keys["old"] + use_keys["new"])
+
+        uses = main.query_coffee_uses_db(n_last=5)
+        assert set(uses.keys()).issubset(use_keys["new"])
+
+        since = datetime.now() - timedelta(days=7)
+        uses = main.query_coffee_uses_db(since=since)
+        assert set(uses.keys()).issubset(use_keys["new"])
+
+        since = datetime.now() - timedelta(days=200)
+        uses = main.query_coffee_uses_db(since=since)
+        assert all(u.datetime > since for u in uses.values())
+        assert len(set(uses.keys()).intersection(use_keys["old"])) > 0
+
+        assert main.count_coffee_uses() == 40
+        assert main.count_coffee_uses(bag_id="BAG-0") == 14
+
+    def test_delete_archived_uses(self, use_keys: Dict[str, List[str]]):
+        main.archive_coffee_uses(horizon_days=30)
+        n_segments = len(main.get_archive().segment_names())
+        main._delete_coffee_use(use_keys["old"][0])
+        main._delete_coffee_use(use_keys["new"][0])
+        main._delete_coffee_use("not-a-use")
+        uses = main.query_coffee_uses_db()
+        assert use_keys["old"][0] not in uses
+        assert use_keys["new"][0] not in uses
+        assert len(uses) == 38
+        assert main.num_coffee_uses() == 38
+        assert main.count_coffee_uses() == 38
+        assert len(main.get_archive().segment_names()) <= n_segments
+
+    def test_segments_changed_elsewhere(self, use_keys: Dict[str, List[str]]):
+        main.archive_coffee_uses(horizon_days=30)
+        assert main.count_coffee_uses() == 40
+        # Another worker deletes an archived use and bumps the generation.
+        other = SegmentArchive(main.get_archive().drive)
+        meta = main.read_meta_info()
+        horizon = main.get_archive_horizon(meta)
+        generation = main.get_archive_generation(meta)
+        other.delete(use_keys["old"][:1], horizon=horizon, generation=generation)
+        main.bump_archive_generation()
+        assert main.count_coffee_uses() == 39
+        uses = main.query_coffee_uses_db()
+        assert len(uses) == 39
+        assert use_keys["old"][0] not in uses
+
+        # A segment listed before it was replaced is read from its successor.
+        n_archived = len(list(other.read()))
+        archive = SegmentArchive(other.drive)
+        archive.segment_names(horizon=horizon, generation=generation)
+        other.delete(use_keys["old"][1:2], horizon=horizon, generation=generation)
+        keys = {
+            info["key"] for info in archive.read(horizon=horizon, generation=generation)
+        }
+        assert len(keys) == n_archived - 1
+        assert use_keys["old"][1] not in keys
+
+    def test_horizon_keeps_counters_on_backend_error(
+        self, use_keys: Dict[str, List[str]]
+    ):
+        db = main.meta_db.resolve()
+        policy = CallPolicy(write_timeout=0.05)
+        main.meta_db._bases[None] = ResilientBase(db, name="meta_db", policy=policy)
+        db.update = lambda *args, **kwargs: sleep(0.2)
+        with pytest.raises(BackendTimeout):
+            main.set_archive_horizon(1.0)
+        assert main.read_meta_info()[main.MetaDataField.use_count] == 40
+
+    def test_delete_all_uses_clears_archive(self, use_keys: Dict[str, List[str]]):
+        main.archive_coffee_uses(horizon_days=30)
+        main._delete_all_coffee_uses()
+        assert main.get_archive_horizon() is None
+        assert main.get_archive().segment_names() == []
+        assert main.count_coffee_uses() == 0
+
+
 #### ---- HTTP Exceptions ---- ####
 
 
@@ -209,6 +669,585 @@ class TestHttpExceptions:
         assert "SOME FIELD" in err.value.detail
 
 
+#### ---- Profiling ---- ####
+
+
+class TestProfiler:
+    @pytest.fixture
+    def session(self) -> profiler.ProfilingSession:
+        profile = profiler.RequestProfile(
+            id="ID", method="GET", path="/uses/", started=datetime.now()
+        )
+        return profiler.ProfilingSession(profile)
+
+    def test_phase_without_session(self):
+        with profiler.phase("nothing"):
+            pass
+
+    def test_phase_records_time(self, session: profiler.ProfilingSession):
+        token = profiler._current_session.set(session)
+        try:
+            with profiler.phase("deta_fetch"):
+                pass
+            with profiler.phase("deta_fetch"):
+                pass
+        finally:
+            profiler._current_session.reset(token)
+        assert list(session.profile.phases.keys()) == ["deta_fetch"]
+        assert session.profile.phases["deta_fetch"] >= 0.0
+
+    def test_finish(self, session: profiler.ProfilingSession):
+        session.add_phase("endpoint", 0.001)
+        profile = session.finish()
+        assert profile.total_ms > 0.0
+        assert "framework" in profile.phases
+        assert profiler.profile_store.get(profile.id) is profile
+        assert "total;dur=" in profiler.server_timing(profile)
+
+    def test_profile_store_maxlen(self):
+        store = profiler.ProfileStore(maxlen=2)
+        for i in range(3):
+            store.add(
+                profiler.RequestProfile(
+                    id=str(i), method="GET", path="/", started=datetime.now()
+                )
+            )
+        assert [p.id for p in store.list()] == ["2", "1"]
+        assert store.get("0") is None
+        store.clear()
+        assert store.list() == []
+
+    def test_get_profiles_password(self):
+        response = client.get(f"/profiles/?password={mock_password()}")
+        assert response.status_code == 401
+
+    def test_profile_header_password(self):
+        # Random passwords can contain characters that are invalid in headers.
+        response = client.get("/", headers={"X-Profile": "not-the-password"})
+        assert response.status_code == 200
+        assert "x-profile-id" not in response.headers
+
+    def test_redact_query(self):
+        query = profiler.redact_query(b"password=s3cret&n_last=5&tenant_password=x")
+        assert "s3cret" not in query
+        assert "n_last=5" in query
+        assert profiler.redact_query(b"") == ""
+
+
+#### ---- Change events ---- ####
+
+
+class TestEvents:
+    def test_listener(self):
+        broadcaster = Broadcaster()
+        received = []
+        broadcaster.add_listener(received.append)
+        event = broadcaster.publish(Collection.uses, ChangeOp.put, key="KEY")
+        assert received == [event]
+        assert event.id == 1
+
+    def test_tenant_subscriptions(self):
+        async def consume():
+            broadcaster = Broadcaster()
+            subscription = broadcaster.subscribe(tenant="team-a")
+            broadcaster.publish(Collection.bags, ChangeOp.put, key="A", tenant="team-a")
+            broadcaster.publish(Collection.bags, ChangeOp.put, key="B")
+            await asyncio.sleep(0)
+            queue = subscription.queue
+            return [queue.get_nowait().key for _ in range(queue.qsize())]
+
+        assert asyncio.run(consume()) == ["A"]
+
+    def test_event_stream(self):
+        async def consume():
+            broadcaster = Broadcaster(queue_size=2)
+            stream = event_stream(broadcaster, heartbeat=0.01)
+            assert await stream.__anext__() == ": heartbeat\n\n"
+            assert broadcaster.n_subscribers == 1
+
+            for i in range(3):
+                broadcaster.publish(Collection.bags, ChangeOp.delete, key=str(i))
+            await asyncio.sleep(0.01)
+
+            lagged = await stream.__anext__()
+            assert lagged.startswith("event: lagged")
+            message = await stream.__anext__()
+            assert "event: bags" in message
+            assert '"key": "1"' in message
+
+            await stream.aclose()
+            assert broadcaster.n_subscribers == 0
+
+        asyncio.run(consume())
+
+
+@pytest.mark.usefixtures("local_databases")
+class TestChangeFeed:
+    @pytest.fixture(autouse=True)
+    def no_delay(self, monkeypatch):
+        monkeypatch.setattr(main.change_log, "delay", 0.0)
+
+    def test_sequence_is_monotonic(self):
+        sequence = SequenceGenerator()
+        blocks = [sequence.next_block() for _ in range(1000)]
+        assert blocks == sorted(set(blocks))
+        assert all(block % SEQ_BLOCK == 0 for block in blocks)
+        assert all(b - a >= SEQ_BLOCK for a, b in zip(blocks, blocks[1:]))
+
+    def test_writers_share_sequence(self):
+        # Two writers whose clocks give the same numbers never share one.
+        db = LocalBase("change_db")
+        first = ChangeLog(db, sequence=SequenceGenerator(lambda: 1.0e9), delay=0.0)
+        second = ChangeLog(db, sequence=SequenceGenerator(lambda: 1.0e9), delay=0.0)
+        items: List[Tuple[str, Optional[Dict[str, Any]]]] = [
+            (str(i), None) for i in range(20)
+        ]
+        first.record(Collection.uses, ChangeOp.delete, items)
+        for item in items:
+            second.record(Collection.uses, ChangeOp.delete, [item])
+        seqs = [c.seq for c in first.read(limit=100).changes]
+        assert len(seqs) == 40
+        assert len(set(seqs)) == 40
+
+    def test_batches_are_written_in_blocks(self):
+        db = CountingBase("change_db")
+        change_log = ChangeLog(db, delay=0.0)
+        items: List[Tuple[str, Optional[Dict[str, Any]]]] = [
+            (str(i), None) for i in range(51)
+        ]
+        change_log.record(Collection.uses, ChangeOp.delete, items)
+        assert db.n_inserts == 3
+        assert db.n_put_manys == 2
+        changes = change_log.read(limit=100).changes
+        assert [c.key for c in changes] == [str(i) for i in range(51)]
+
+    def test_failed_records_are_retried(self, password: str, monkeypatch):
+        bag = CoffeeBag(brand="BRAND", name="NAME")
+        main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+        main.initialize_meta_db(bag_count=1)
+        change_db = main.change_db.resolve()
+        insert = change_db.insert
+
+        def fail_insert(*args, **kwargs):
+            raise ConnectionError("change_db is down")
+
+        # The write succeeds (once) and its change is recorded later.
+        monkeypatch.setattr(change_db, "insert", fail_insert)
+        response = client.put(f"/new_use/{bag._key}?password={password}")
+        assert response.status_code == 200
+        assert main.num_coffee_uses() == 1
+        main._delete_all_coffee_uses()
+        assert main.num_coffee_uses() == 0
+        assert main.change_log.pending == 2
+
+        monkeypatch.setattr(change_db, "insert", insert)
+        changes = client.get("/changes/").json()["changes"]
+        assert [c["op"] for c in changes] == ["put", "delete"]
+        assert main.change_log.pending == 0
+
+    def test_recent_changes_are_held_back(self, monkeypatch):
+        main.publish_change(Collection.uses, ChangeOp.delete, key="A")
+        monkeypatch.setattr(main.change_log, "delay", 60.0)
+        assert client.get("/changes/").json() == {
+            "changes": [],
+            "last": 0,
+            "more": False,
+        }
+
+    def test_record_round_trip(self):
+        change_log = main.change_log
+        change_log.record(Collection.bags, ChangeOp.put, [("A", {"brand": "B"})])
+        change = change_log.read().changes[0]
+        assert change.key == "A"
+        assert change.data == {"brand": "B"}
+
+    def test_changes(self):
+        bag = CoffeeBag(brand="BRAND", name="NAME")
+        main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+        main.initialize_meta_db(bag_count=1)
+        main.publish_bag_change(ChangeOp.put, bag)
+        uses = [CoffeeUse(bag_id=bag._key, datetime=gen_datetime()) for _ in range(5)]
+        for use in uses:
+            main.coffee_use_db.put(main.convert_use_to_info(use))
+            main.publish_change(Collection.uses, ChangeOp.put, key=use._key)
+        main._delete_coffee_bag(bag._key, cascade=True)
+
+        changes = client.get("/changes/").json()
+        assert not changes["more"]
+        ops = [(c["collection"], c["op"]) for c in changes["changes"]]
+        assert ops[0] == ("bags", "put")
+        assert ops[1:6] == [("uses", "put")] * 5
+        assert ops[6] == ("bags", "delete")
+        assert ops[7:] == [("uses", "delete")] * 5
+        assert all(c["data"] is None for c in changes["changes"][6:])
+        seqs = [c["seq"] for c in changes["changes"]]
+        assert seqs == sorted(seqs)
+        assert changes["last"] == seqs[-1]
+
+        response = client.get(f"/changes/?after={changes['last']}").json()
+        assert response == {"changes": [], "last": changes["last"], "more": False}
+
+    def test_paging(self):
+        for i in range(7):
+            main.publish_change(Collection.uses, ChangeOp.delete, key=str(i))
+        keys: List[str] = []
+        after = 0
+        while True:
+            page = client.get(f"/changes/?after={after}&limit=3").json()
+            keys += [c["key"] for c in page["changes"]]
+            after = page["last"]
+            if not page["more"]:
+                break
+        assert keys == [str(i) for i in range(7)]
+
+
+#### ---- Snapshot ---- ####
+
+
+@pytest.mark.usefixtures("local_databases")
+class TestSnapshot:
+    @pytest.fixture(autouse=True)
+    def seed(self, local_databases):
+        for i in range(3):
+            bag = CoffeeBag(brand="BRAND", name=f"NAME {i}")
+            main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+            for _ in range(10):
+                use = CoffeeUse(bag_id=bag._key, datetime=gen_datetime())
+                main.coffee_use_db.put(main.convert_use_to_info(use))
+        main.initialize_meta_db(bag_count=3, use_count=30)
+
+    def test_get_snapshot(self):
+        response = client.get("/snapshot/")
+        assert response.status_code == 200
+        assert response.headers["accept-ranges"] == "bytes"
+        data = decode_snapshot(response.content)
+        assert len(data["bags"]["key"]) == 3
+        assert len(data["uses"]["key"]) == 30
+        assert data["uses"]["datetime"] == sorted(data["uses"]["datetime"])
+
+    def test_snapshot_not_modified(self):
+        etag = client.get("/snapshot/").headers["etag"]
+        response = client.get("/snapshot/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        response = client.get("/snapshot/", headers={"If-None-Match": '"other"'})
+        assert response.status_code == 200
+
+    def test_snapshot_range(self):
+        full = client.get("/snapshot/").content
+        response = client.get("/snapshot/", headers={"Range": "bytes=10-19"})
+        assert response.status_code == 206
+        assert response.content == full[10:20]
+        assert response.headers["content-range"] == f"bytes 10-19/{len(full)}"
+        response = client.get("/snapshot/", headers={"Range": "bytes=-5"})
+        assert response.content == full[-5:]
+        response = client.get("/snapshot/", headers={"Range": f"bytes={len(full)}-"})
+        assert response.status_code == 416
+        response = client.get(
+            "/snapshot/", headers={"Range": "bytes=0-9", "If-Range": '"other"'}
+        )
+        assert response.status_code == 200
+        assert response.content == full
+
+    def test_parse_range(self):
+        assert parse_range("bytes=0-", 10) == (0, 9)
+        assert parse_range("bytes=5-100", 10) == (5, 9)
+        assert parse_range("bytes=-20", 10) == (0, 9)
+        assert parse_range("bytes=0-1,3-4", 10) is None
+        assert parse_range("items=0-1", 10) is None
+        assert parse_range("bytes=5-2", 10) is None
+        with pytest.raises(ValueError):
+            parse_range("bytes=10-", 10)
+
+    def test_debounced_rebuild(self):
+        n_builds = 0
+
+        def build() -> Snapshot:
+            nonlocal n_builds
+            n_builds += 1
+            return Snapshot(b"data", created=datetime.now())
+
+        materializer = SnapshotMaterializer(build, delay=0.05)
+        for _ in range(5):
+            materializer.mark_dirty()
+        sleep(0.3)
+        assert n_builds == 1
+        materializer.get()
+        assert n_builds == 1
+
+    def test_writes_rebuild_requested_snapshots(self, monkeypatch):
+        n_builds = 0
+        build_snapshot = main.build_snapshot
+
+        def counting_build() -> Snapshot:
+            nonlocal n_builds
+            n_builds += 1
+            return build_snapshot()
+
+        monkeypatch.setattr(main, "SNAPSHOT_DELAY", 0.01)
+        monkeypatch.setattr(main, "build_snapshot", counting_build)
+        bag = CoffeeBag(brand="BRAND", name="NAME")
+        main.publish_bag_change(ChangeOp.put, bag)
+        sleep(0.1)
+        assert n_builds == 0
+
+        assert client.get("/snapshot/").status_code == 200
+        main.publish_bag_change(ChangeOp.put, bag)
+        sleep(0.1)
+        assert n_builds == 2
+
+
+#### ---- Bag search ---- ####
+
+
+class TestBagIndex:
+    @pytest.fixture
+    def index(self) -> BagIndex:
+        index = BagIndex()
+        bags = [
+            ("a", "Blue Bottle", "Hayes Valley Espresso"),
+            ("b", "Bluebird Botanicals", "Morning Blend"),
+            ("c", "Café Olé", "Blue Blend"),
+            ("d", "Stumptown", "Hair Bender"),
+        ]
+        index.load([{"key": k, "brand": b, "name": n} for k, b, n in bags], version=0)
+        return index
+
+    def search(self, index: BagIndex, q: str, **kwargs: Any) -> List[str]:
+        return [info["key"] for info in index.search(q, **kwargs)]
+
+    def test_prefix_search(self, index: BagIndex):
+        assert self.search(index, "blue") == ["a", "c", "b"]
+        assert self.search(index, "BLUE bot") == ["a", "b"]
+        assert self.search(index, "cafe ole") == ["c"]
+        assert self.search(index, "blue", limit=1) == ["a"]
+        assert self.search(index, "tea") == []
+        assert self.search(index, "  ") == []
+
+    def test_fuzzy_search(self, index: BagIndex):
+        assert self.search(index, "espreso") == []
+        assert self.search(index, "espreso", fuzzy=True) == ["a"]
+        assert self.search(index, "stumptwn bender", fuzzy=True) == ["d"]
+
+    def test_changes(self, index: BagIndex):
+        index.add("d", {"key": "d", "brand": "Stumptown", "name": "Holler Mountain"})
+        assert self.search(index, "hair") == []
+        assert self.search(index, "holler") == ["d"]
+        index.remove("a")
+        assert self.search(index, "espresso") == []
+
+    def test_load_keeps_newer_changes(self, index: BagIndex):
+        version = index.version
+        index.add("e", {"key": "e", "brand": "Onyx", "name": "Geometry"})
+        index.remove("d")
+        infos = [{"key": "d", "brand": "Stumptown", "name": "Hair Bender"}]
+        index.load(infos, version=version)
+        assert len(index) == 1
+        assert self.search(index, "onyx") == ["e"]
+        assert self.search(index, "stumptown") == []
+
+
+@pytest.mark.usefixtures("local_databases", "password")
+class TestBagSearch:
+    @pytest.fixture(autouse=True)
+    def bags(self, local_databases) -> List[CoffeeBag]:
+        bags = [
+            CoffeeBag(brand="Counter Culture", name="Hologram"),
+            CoffeeBag(brand="Counter Culture", name="Big Trouble"),
+            CoffeeBag(brand="Onyx", name="Southern Weather"),
+        ]
+        for bag in bags:
+            main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+        return bags
+
+    def search(self, q: str, **params: Any) -> List[str]:
+        response = client.get("/bags/search/", params=dict(q=q, **params))
+        assert response.status_code == 200
+        return list(response.json().keys())
+
+    def test_search(self, bags: List[CoffeeBag]):
+        assert self.search("counter") == [bags[1]._key, bags[0]._key]
+        assert self.search("holo") == [bags[0]._key]
+        assert self.search("weathr", fuzzy=True) == [bags[2]._key]
+        assert client.get("/bags/search/", params={"q": ""}).status_code == 422
+
+    def test_index_follows_writes(self, bags: List[CoffeeBag]):
+        assert self.search("onyx") == [bags[2]._key]
+        bag = CoffeeBag(brand="Onyx", name="Geometry")
+        response = client.put(
+            f"/new_bag/?password={TEST_PASSWORD}", json=jsonable_encoder(bag)
+        )
+        assert response.status_code == 200
+        assert len(self.search("onyx geometry")) == 1
+        response = client.patch(
+            f"/update_bag/{bags[2]._key}",
+            params={"field": "name", "value": "Monarch", "password": TEST_PASSWORD},
+        )
+        assert response.status_code == 200
+        assert self.search("monarch") == [bags[2]._key]
+        assert self.search("southern") == []
+        response = client.delete(
+            f"/delete_bag/{bags[0]._key}", params={"password": TEST_PASSWORD}
+        )
+        assert response.status_code == 200
+        assert self.search("hologram") == []
+
+
+#### ---- Tenants ---- ####
+
+
+@pytest.mark.usefixtures("local_databases")
+class TestTenants:
+    @pytest.fixture
+    def tenant(self) -> Dict[str, str]:
+        tenant = {"name": "team-a", "password": "team-a-password"}
+        main.tenant_registry.put(
+            tenant["name"], main.get_pwd_context().hash(tenant["password"])
+        )
+        main.initialize_meta_db()
+        with main.tenant_scope(tenant["name"]):
+            main.initialize_meta_db()
+        return tenant
+
+    def test_tenant_collections(self, tenant: Dict[str, str]):
+        headers = {"X-Tenant": tenant["name"]}
+        bag = CoffeeBag(brand="BRAND", name="NAME")
+        response = client.put(
+            f"/new_bag/?password={tenant['password']}",
+            json=jsonable_encoder(bag),
+            headers=headers,
+        )
+        assert response.status_code == 200
+
+        assert len(client.get("/bags/", headers=headers).json()) == 1
+        assert client.get("/number_of_bags/", headers=headers).json() == 1
+        assert client.get(f"/bags/?tenant={tenant['name']}").json() != {}
+        assert client.get("/bags/").json() == {}
+        assert client.get("/number_of_bags/").json() == 0
+
+    def test_tenant_password(self, tenant: Dict[str, str]):
+        response = client.put(
+            "/new_bag/?password=other-password",
+            json=jsonable_encoder(CoffeeBag(brand="BRAND", name="NAME")),
+            headers={"X-Tenant": tenant["name"]},
+        )
+        assert response.status_code == 401
+
+    def test_reads_are_public(self, tenant: Dict[str, str]):
+        # Reads need only the tenant's name, writes its password as well.
+        headers = {"X-Tenant": tenant["name"]}
+        for path in ("/bags/", "/uses/", "/number_of_uses/", "/changes/"):
+            assert client.get(path, headers=headers).status_code == 200
+
+    def test_unknown_tenant(self):
+        assert client.get("/bags/", headers={"X-Tenant": "nobody"}).status_code == 404
+        assert client.get("/bags/", headers={"X-Tenant": "No Body"}).status_code == 400
+
+    def test_admin_endpoints(self, tenant: Dict[str, str]):
+        response = client.get(
+            f"/tenants/?password={tenant['password']}",
+            headers={"X-Tenant": tenant["name"]},
+        )
+        assert response.status_code == 403
+
+    def test_parallel_reads_and_deletes(self, tenant: Dict[str, str]):
+        with main.tenant_scope(tenant["name"]):
+            uses = [CoffeeUse(bag_id="BAG", datetime=datetime.now()) for _ in range(5)]
+            for use in uses:
+                main.coffee_use_db.put(main.convert_use_to_info(use))
+            since = datetime.now() - timedelta(days=3)
+            assert main.count_coffee_uses(since=since) == 5
+            main.delete_keys(main.coffee_use_db, [u._key for u in uses[:2]])
+            assert main.count_coffee_uses(since=since) == 3
+        assert main.count_coffee_uses(since=since) == 0
+
+    def test_lazy_base_per_tenant(self, monkeypatch):
+        created = []
+
+        def factory(name: str) -> LocalBase:
+            created.append(name)
+            return LocalBase(name)
+
+        monkeypatch.setattr(main, "base_factory", factory)
+        db = main.LazyBase("lazy_db")
+        db.put({"value": 1}, key="a")
+        with main.tenant_scope("team-b"):
+            assert db.get("a") is None
+        with main.tenant_scope("team-b"):
+            db.put({"value": 2}, key="a")
+        assert db.get("a")["value"] == 1
+        assert created == ["lazy_db", "lazy_db-team-b"]
+
+
+#### ---- Response formats ---- ####
+
+
+@pytest.mark.usefixtures("local_databases")
+class TestResponseFormats:
+    @pytest.fixture(autouse=True)
+    def seed(self, local_databases):
+        for i in range(3):
+            bag = CoffeeBag(brand="BRAND", name=f"NAME {i}", start=gen_date())
+            main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+            for _ in range(20):
+                use = CoffeeUse(bag_id=bag._key, datetime=gen_datetime())
+                main.coffee_use_db.put(main.convert_use_to_info(use))
+        main.initialize_meta_db(bag_count=3, use_count=60)
+
+    def test_negotiate(self):
+        assert formats.negotiate(None) == formats.JSON
+        assert formats.negotiate("*/*") == formats.JSON
+        assert formats.negotiate("text/html") is None
+        accept = "application/json;q=0.5, application/vnd.coffee-counter.columnar+json"
+        assert formats.negotiate(accept) == formats.COLUMNAR_JSON
+        accept = "application/x-msgpack, application/*;q=0.1"
+        expected = formats.JSON if formats.msgpack is None else formats.MSGPACK
+        assert formats.negotiate(accept) == expected
+
+    def test_columnar_uses(self):
+        default = client.get("/uses/?n_last=1000").json()
+        response = client.get(
+            "/uses/?n_last=1000", headers={"Accept": formats.COLUMNAR_JSON}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == formats.COLUMNAR_JSON
+        columns = response.json()
+        assert set(columns["key"]) == set(default.keys())
+        for key, bag_id in zip(columns["key"], columns["bag_id"]):
+            assert default[key]["bag_id"] == bag_id
+        assert all(isinstance(t, int) for t in columns["timestamp_ms"])
+
+    def test_columnar_bags(self):
+        default = client.get("/bags/").json()
+        response = client.get("/bags/", headers={"Accept": formats.COLUMNAR_JSON})
+        columns = response.json()
+        assert set(columns["key"]) == set(default.keys())
+        for i, key in enumerate(columns["key"]):
+            assert default[key]["start"] == columns["start"][i]
+
+    def test_msgpack_uses(self):
+        msgpack = pytest.importorskip("msgpack")
+        response = client.get("/uses/?n_last=1000", headers={"Accept": formats.MSGPACK})
+        assert response.headers["content-type"] == formats.MSGPACK
+        assert len(msgpack.unpackb(response.content)["key"]) == 60
+
+    def test_not_acceptable(self):
+        response = client.get("/uses/", headers={"Accept": "text/csv"})
+        assert response.status_code == 406
+
+    def test_vary_accept(self):
+        for accept in [formats.JSON, formats.COLUMNAR_JSON, "text/csv"]:
+            response = client.get("/bags/", headers={"Accept": accept})
+            assert response.headers["vary"] == "Accept"
+
+    def test_gzip(self):
+        headers = {"Accept-Encoding": "gzip"}
+        response = client.get("/uses/?n_last=1000", headers=headers)
+        assert response.headers["content-encoding"] == "gzip"
+        assert len(response.json()) == 60
+        response = client.get("/snapshot/", headers=headers)
+        assert "content-encoding" not in response.headers
+
+
 #### ---- Test Getters ---- ####
 @pytest.mark.getter
 class TestGetters:
@@ -319,6 +1358,20 @@ class TestGetters:
         assert isinstance(response.json(), int)
         assert response.json() > 0
 
+    def test_get_dashboard(self):
+        response = client.get("/dashboard/?n_last=5")
+        assert response.status_code == 200
+        dashboard = response.json()
+        assert len(dashboard["recent_uses"].keys()) == 5
+        assert dashboard["number_of_bags"] > 0
+        assert dashboard["number_of_uses"] > 0
+        assert dashboard["active_bag_uses"].keys() == dashboard["active_bags"].keys()
+        for key, info in dashboard["active_bags"].items():
+            assert isinstance(CoffeeBag(_key=key, **info), CoffeeBag)
+
+        response = client.get("/dashboard/?n_last=0")
+        assert response.status_code != 200
+
     def test_get_number_of_uses_since_bag_id(self, bag_id: str):
         for _ in range(N_TRIES):
             response = client.get(
@@ -328,6 +1381,264 @@ class TestGetters:
             assert isinstance(response.json(), int)
 
 
+@pytest.mark.usefixtures("local_databases")
+class TestDayIndex:
+    @pytest.fixture
+    def uses(self) -> List[CoffeeUse]:
+        now = datetime.now()
+        uses = [
+            CoffeeUse(bag_id=f"BAG-{i % 2}", datetime=now - timedelta(hours=i * 7))
+            for i in range(200)
+        ]
+        for use in uses:
+            main.coffee_use_db.put(main.convert_use_to_info(use))
+        main.initialize_meta_db(bag_count=2, use_count=len(uses), day_index=True)
+        return uses
+
+    def test_use_info_has_day(self):
+        use = CoffeeUse(bag_id="BAG", datetime=datetime(2021, 3, 11, 23, 59))
+        assert main.convert_use_to_info(use)["_day"] == "2021-03-11"
+
+    def test_day_index_only_for_new_databases(self):
+        main.set_archive_horizon(1.0)
+        assert main.read_meta_info()[main.MetaDataField.day_index]
+        # A database from before the day buckets keeps scanning.
+        main.meta_db.put({"bag_count": 1, "use_count": 2}, key=main.META_DB_KEY)
+        main.set_archive_horizon(2.0)
+        meta = main.read_meta_info()
+        assert meta[main.MetaDataField.use_count] == 2
+        assert main.MetaDataField.day_index not in meta
+
+    def test_day_buckets(self):
+        meta = {main.MetaDataField.day_index: True}
+        since = datetime.now() - timedelta(days=2)
+        assert len(main.day_buckets(since, meta)) == 4
+        assert main.day_buckets(since, {}) is None
+        assert main.day_buckets(since - timedelta(days=60), meta) is None
+        assert main.day_buckets(None, meta) is None
+
+    @pytest.mark.parametrize("days", [1, 7, 20, 45])
+    def test_since_queries(self, uses: List[CoffeeUse], days: int):
+        since = datetime.now() - timedelta(days=days)
+        expected = {u._key for u in uses if u.datetime > since}
+        res = main.query_coffee_uses_db(n_last=10000, since=since)
+        assert set(res.keys()) == expected
+        assert main.count_coffee_uses(since=since) == len(expected)
+        expected = {u._key for u in uses if u.datetime > since and u.bag_id == "BAG-0"}
+        assert main.count_coffee_uses(since=since, bag_id="BAG-0") == len(expected)
+
+    @pytest.mark.parametrize("n_last", [5, 50, 150])
+    def test_n_last_queries(self, uses: List[CoffeeUse], n_last: int):
+        expected = {u._key for u in uses[:n_last]}
+        assert set(main.query_coffee_uses_db(n_last=n_last).keys()) == expected
+        bag_uses = [u for u in uses if u.bag_id == "BAG-1"]
+        res = main.query_coffee_uses_db(n_last=n_last, bag_id="BAG-1")
+        assert set(res.keys()) == {u._key for u in bag_uses[:n_last]}
+
+    def test_sparse_recent_uses(self, monkeypatch):
+        # Two uses a day over two years: the recent windows hold too few uses.
+        monkeypatch.setattr(main, "CACHE_TTL", 0)
+        main.use_base_factory(CountingBase)
+        now = datetime.now()
+        uses = [
+            CoffeeUse(bag_id="BAG", datetime=now - timedelta(hours=12 * i))
+            for i in range(1460)
+        ]
+        main.coffee_use_db.put_many([main.convert_use_to_info(u) for u in uses])
+        main.initialize_meta_db(bag_count=1, use_count=len(uses), day_index=True)
+        db = main.coffee_use_db.resolve()
+        n_scan = -(-len(uses) // paging.DEFAULT_BUFFER)
+        expected = {u._key for u in uses[:100]}
+
+        # Each day bucket is fetched once before all uses are scanned.
+        assert set(main.query_coffee_uses_db(n_last=100).keys()) == expected
+        since = today_at_midnight() - timedelta(days=29)
+        n_days = len(main.day_buckets(since, {main.MetaDataField.day_index: True}))
+        assert db.n_fetches == n_days + n_scan
+
+        # From then on the windows are skipped.
+        db.n_fetches = 0
+        assert set(main.query_coffee_uses_db(n_last=100).keys()) == expected
+        assert db.n_fetches == n_scan
+        db.n_fetches = 0
+        assert len(main.query_coffee_uses_db(n_last=5)) == 5
+        assert db.n_fetches == 9
+
+    def test_dashboard_reads_meta_once(self, uses: List[CoffeeUse], monkeypatch):
+        monkeypatch.setattr(main, "CACHE_TTL", 0)
+        n_gets = 0
+        meta_db = main.meta_db.resolve()
+        get = meta_db.get
+
+        def counting_get(*args: Any, **kwargs: Any) -> Any:
+            nonlocal n_gets
+            n_gets += 1
+            return get(*args, **kwargs)
+
+        monkeypatch.setattr(meta_db, "get", counting_get)
+        assert client.get("/dashboard/").status_code == 200
+        assert n_gets == 1
+
+    def test_dashboard_counts_uses_in_one_pass(
+        self, uses: List[CoffeeUse], monkeypatch
+    ):
+        for bag_id in ("BAG-0", "BAG-1"):
+            info = main.convert_bag_to_info(CoffeeBag(brand="BRAND", name=bag_id))
+            main.coffee_bag_db.put(dict(info, key=bag_id))
+        main.archive_coffee_uses(horizon_days=30)
+        use_db = main.coffee_use_db.resolve()
+        n_fetches = 0
+        fetch = use_db._fetch
+
+        def counting_fetch(*args: Any, **kwargs: Any) -> Any:
+            nonlocal n_fetches
+            n_fetches += 1
+            return fetch(*args, **kwargs)
+
+        monkeypatch.setattr(use_db, "_fetch", counting_fetch)
+        meta = main.read_meta_info()
+        counts = main.count_coffee_uses_by_bag(["BAG-0", "BAG-1", "BAG-2"], meta)
+        assert counts == {"BAG-0": 100, "BAG-1": 100, "BAG-2": 0}
+        assert n_fetches == 1
+        dashboard = client.get("/dashboard/").json()
+        assert dashboard["active_bag_uses"] == {"BAG-0": 100, "BAG-1": 100}
+
+
+#### ---- Test Setters ---- ####
+
+
+@pytest.mark.usefixtures("local_databases")
+class TestDeleteUses:
+    @pytest.fixture
+    def bag_ids(self) -> List[str]:
+        bags = [CoffeeBag(brand="BRAND", name=f"NAME {i}") for i in range(3)]
+        for bag in bags:
+            main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+        bag_ids = [bag._key for bag in bags]
+        for i in range(30):
+            use = CoffeeUse(bag_id=bag_ids[i % 3], datetime=gen_datetime())
+            main.coffee_use_db.put(main.convert_use_to_info(use))
+        main.initialize_meta_db(bag_count=3, use_count=30)
+        return bag_ids
+
+    def test_delete_bag_without_cascade(self, bag_ids: List[str]):
+        main._delete_coffee_bag(bag_ids[0])
+        assert main.num_coffee_bags() == 2
+        assert main.num_coffee_uses() == 30
+
+    def test_delete_bag_cascade(self, bag_ids: List[str]):
+        main._delete_coffee_bag(bag_ids[0], cascade=True)
+        assert main.num_coffee_bags() == 2
+        assert main.num_coffee_uses() == 20
+        assert main.count_coffee_uses(bag_id=bag_ids[0]) == 0
+        assert main.count_coffee_uses(bag_id=bag_ids[1]) == 10
+
+    def test_compact_coffee_uses(self, bag_ids: List[str]):
+        main.coffee_bag_db.delete(bag_ids[1])
+        assert main.compact_coffee_uses() == 10
+        assert main.num_coffee_uses() == 20
+        assert main.count_coffee_uses() == 20
+        assert main.compact_coffee_uses() == 0
+
+    def test_delete_bags_cascade(self, bag_ids: List[str], monkeypatch):
+        increments: List[int] = []
+        increment = main.increment_coffee_use
+
+        def count_increments(by: int):
+            increments.append(by)
+            increment(by)
+
+        monkeypatch.setattr(main, "increment_coffee_use", count_increments)
+        main._delete_coffee_bags(bag_ids[:2], cascade=True)
+        assert increments == [-20]
+        assert main.num_coffee_bags() == 1
+        assert main.num_coffee_uses() == 10
+        assert main.count_coffee_uses() == 10
+
+    def test_compact_keeps_new_bags(self, bag_ids: List[str], monkeypatch):
+        fetch_pages = main.fetch_pages
+        bag = CoffeeBag(brand="BRAND", name="NEW")
+
+        def add_bag_during_scan(*args, **kwargs):
+            for i, page in enumerate(fetch_pages(*args, **kwargs)):
+                if i == 0:
+                    # Created after the bags were read, used before it is seen.
+                    main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+                    use = CoffeeUse(bag_id=bag._key, datetime=gen_datetime())
+                    main.coffee_use_db.put(main.convert_use_to_info(use))
+                    page = page + [main.convert_use_to_info(use)]
+                yield page
+
+        monkeypatch.setattr(main, "fetch_pages", add_bag_during_scan)
+        assert main.compact_coffee_uses() == 0
+        assert main.count_coffee_uses(bag_id=bag._key) == 1
+
+    def test_compact_ignores_cache(self, bag_ids: List[str], monkeypatch):
+        # A bag added by another worker is not in this worker's cache.
+        monkeypatch.setattr(main, "CACHE_TTL", 60)
+        main.get_all_coffee_bag_info()
+        bag = CoffeeBag(brand="BRAND", name="ELSEWHERE")
+        main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+        for _ in range(3):
+            use = CoffeeUse(bag_id=bag._key, datetime=gen_datetime())
+            main.coffee_use_db.put(main.convert_use_to_info(use))
+        assert main.compact_coffee_uses() == 0
+        assert main.count_coffee_uses(bag_id=bag._key) == 3
+
+
+@pytest.mark.usefixtures("local_databases", "password")
+class TestBatchUpdate:
+    @pytest.fixture
+    def bag_ids(self) -> List[str]:
+        bags = [CoffeeBag(brand="BRAND", name=f"NAME {i}") for i in range(3)]
+        for bag in bags:
+            main.coffee_bag_db.put(main.convert_bag_to_info(bag))
+        return [bag._key for bag in bags]
+
+    def patch(self, updates: Dict[str, Any], **params: Any):
+        query = "&".join(f"{k}={v}" for k, v in params.items())
+        return client.patch(
+            f"/update_bags/?password={TEST_PASSWORD}&{query}", json=updates
+        )
+
+    def test_update_bags(self, bag_ids: List[str]):
+        updates = {
+            bag_ids[0]: {"brand": "NEW BRAND", "weight": "250"},
+            bag_ids[1]: {"active": False, "finish": "2021-03-11"},
+            bag_ids[2]: {"brand": None},
+            "MISSING": {"name": "NAME"},
+        }
+        response = self.patch(updates)
+        assert response.status_code == 200
+        results = response.json()
+        assert results[bag_ids[0]]["updated"]
+        assert results[bag_ids[0]]["bag"]["weight"] == 250.0
+        assert results[bag_ids[1]]["updated"]
+        assert not results[bag_ids[2]]["updated"]
+        assert not results["MISSING"]["updated"]
+        assert "not found" in results["MISSING"]["error"]
+
+        bag = main.coffee_bag_db.get(bag_ids[0])
+        assert bag["brand"] == "NEW BRAND"
+        assert bag["name"] == "NAME 0"
+        assert bag["weight"] == 250.0
+        bag = main.coffee_bag_db.get(bag_ids[1])
+        assert not bag["active"]
+        assert bag["finish"] == "2021-03-11"
+        assert main.coffee_bag_db.get(bag_ids[2])["brand"] == "BRAND"
+
+    def test_all_or_nothing(self, bag_ids: List[str]):
+        updates = {bag_ids[0]: {"brand": "NEW BRAND"}, "MISSING": {"name": "NAME"}}
+        response = self.patch(updates, all_or_nothing="true")
+        assert response.status_code == 200
+        assert not any(r["updated"] for r in response.json().values())
+        assert main.coffee_bag_db.get(bag_ids[0])["brand"] == "BRAND"
+
+    def test_invalid_updates(self, bag_ids: List[str]):
+        assert self.patch({bag_ids[0]: {"color": "red"}}).status_code == 422
+        assert self.patch({bag_ids[0]: {"weight": "heavy"}}).status_code == 422
+
+
 #### ---- Test Passwords ---- ####
 
 N_TRIES = 5
@@ -454,6 +1765,55 @@ class TestSetterPasswords:
         )
         assert response.status_code == 401
 
+    def test_delete_orphaned_uses_password(self):
+        for _ in range(N_TRIES):
+            response = client.delete(f"/orphaned_uses/?password={mock_password()}")
+            assert response.status_code == 401
+        response = client.delete("/orphaned_uses/?password=")
+        assert response.status_code == 401
+
+    def test_archive_uses_password(self):
+        for _ in range(N_TRIES):
+            response = client.post(f"/archive_uses/?password={mock_password()}")
+            assert response.status_code == 401
+        response = client.post("/archive_uses/?password=")
+        assert response.status_code == 401
+
+    def test_backend_metrics_password(self):
+        for _ in range(N_TRIES):
+            response = client.get(f"/backend_metrics/?password={mock_password()}")
+            assert response.status_code == 401
+        response = client.get("/backend_metrics/?password=")
+        assert response.status_code == 401
+
+    def test_cache_stats_password(self):
+        for _ in range(N_TRIES):
+            response = client.get(f"/cache_stats/?password={mock_password()}")
+            assert response.status_code == 401
+        response = client.get("/cache_stats/?password=")
+        assert response.status_code == 401
+
+    def test_tenants_password(self):
+        for _ in range(N_TRIES):
+            response = client.get(f"/tenants/?password={mock_password()}")
+            assert response.status_code == 401
+            response = client.put(
+                f"/tenants/team?tenant_password=pw&password={mock_password()}"
+            )
+            assert response.status_code == 401
+        response = client.delete("/tenants/team?password=")
+        assert response.status_code == 401
+
+    def test_update_bags_password(self):
+        for _ in range(N_TRIES):
+            response = client.patch(
+                f"/update_bags/?password={mock_password()}",
+                json={"BAG": {"brand": "BRAND"}},
+            )
+            assert response.status_code == 401
+        response = client.patch("/update_bags/?password=", json={})
+        assert response.status_code == 401
+
     # NOTE: Careful not to use random passwords for this test
     def test_delete_all_uses_password(self):
         response = client.delete("/delete_all_uses/?password=")